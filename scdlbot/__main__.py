@@ -1,71 +1,345 @@
 #!/usr/bin/env python
 
 import asyncio
+import collections
 import concurrent.futures
+import contextlib
 import datetime
+import functools
+import hashlib
+import json
 import logging
+import math
 import os
 import pathlib
 import pickle
 import platform
+import queue
 import random
-import re
 import resource
 import shutil
+import signal
+import sqlite3
 import tempfile
 import threading
 import time
 import traceback
+from abc import ABC, abstractmethod
 from importlib import resources
 from logging.handlers import SysLogHandler
 from multiprocessing import get_context
 from subprocess import PIPE, TimeoutExpired  # skipcq: BAN-B404
+from typing import NamedTuple, Optional
 from urllib.parse import urljoin
-from uuid import uuid4
+from uuid import UUID, uuid4
 
-import ffmpeg
+# Startup time is measured from here, it's exported to Prometheus:
+STARTED = time.monotonic()
+
+try:
+    import fcntl
+except ImportError:
+    # No transcode slots and reflinks on Windows:
+    fcntl = None
+# Linux ioctl for copy-on-write file clone:
+FICLONE = 0x40049409
+
+import httpx
 import prometheus_client
-import requests
 import sdnotify
+from boltons.urlutils import URL
 
 # import gc
 # from boltons.urlutils import find_all_links
-from fake_useragent import UserAgent
-from mutagen.id3 import ID3, ID3v1SaveOptions
-from mutagen.mp3 import EasyMP3 as MP3
-from pebble import ProcessPool
-from telegram import Bot, Chat, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, Update
+from pebble import ProcessExpired, ProcessPool
+from plumbum import ProcessExecutionError, local
+from telegram import Chat, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, MessageEntity, Update
 from telegram.constants import ChatAction
 
 # from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, TelegramError, TimedOut
-from telegram.ext import AIORateLimiter, Application, ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, PicklePersistence, filters
+from telegram.error import BadRequest, ChatMigrated, Forbidden, InvalidToken, NetworkError, RetryAfter, TelegramError
+from telegram.ext import (
+    AIORateLimiter,
+    Application,
+    ApplicationBuilder,
+    BasePersistence,
+    BaseRateLimiter,
+    CallbackQueryHandler,
+    CommandHandler,
+    ContextTypes,
+    ExtBot,
+    MessageHandler,
+    TypeHandler,
+    filters,
+)
 from telegram.helpers import escape_markdown
 from telegram.request import HTTPXRequest
 
 # from telegram_handler import TelegramHandler
 
-# Support different old versions just in case:
-# https://github.com/yt-dlp/yt-dlp/wiki/Forks
-try:
-    import yt_dlp as ydl
-except ImportError:
+
+# Address space limit of each worker process in mebibytes, it's inherited by ffmpeg and other subprocesses (0 means no limit):
+MAX_MEM = int(os.getenv("WORKER_MAX_MEM", "0")) * 1024 * 1024
+# Worker process gets recycled after task only if its RSS is above this high-water mark in mebibytes:
+WORKER_RSS_HIGH_WATER = int(os.getenv("WORKER_RSS_HIGH_WATER", "1000")) * 1024 * 1024
+# Optional fallback recycling of worker processes after this number of tasks (0 means no limit):
+WORKER_MAX_TASKS = int(os.getenv("WORKER_MAX_TASKS", "0"))
+
+
+def pp_initializer(limit):
+    """Set maximum amount of memory each worker process can allocate and start worker event loop."""
+    if limit:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    install_worker_recycling()
+    get_worker_loop()
+
+
+def install_worker_recycling():
+    """Make bloated worker process exit by itself right after its task result is sent.
+
+    Worker exits before it takes next task from pool channel, so no task is lost, and pebble replaces it with a fresh worker
+    just like after max_tasks. Main process can't do it safely by pid, because worker may have already taken next task.
+    """
+    import pebble.pool.process
+    from pebble.common.process import process_exit
+
+    send_result = pebble.pool.process.send_result
+
+    def send_result_and_recycle(channel, result):
+        send_result(channel, result)
+        if WORKER_RECYCLE:
+            process_exit(0)
+
+    pebble.pool.process.send_result = send_result_and_recycle
+
+
+def reset_peak_rss():
+    """Reset peak RSS (VmHWM) of worker process, so it's measured per task. Linux only."""
     try:
-        import youtube_dl as ydl
-    except ImportError:
-        import youtube_dlc as ydl
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
 
-from boltons.urlutils import URL
-from plumbum import ProcessExecutionError, local
 
-# Use maximum 1500 mebibytes per task:
-# TODO Parametrize?
-MAX_MEM = 1500 * 1024 * 1024
+def get_worker_rss():
+    """Return current and peak RSS of worker process in bytes."""
+    rss = {}
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value, unit = line.split()
+                    rss[name] = int(value) * 1024
+    except (OSError, ValueError):
+        pass
+    if len(rss) < 2:
+        # ru_maxrss is peak for the whole worker process lifetime, in kibibytes on Linux:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return rss.get("VmRSS:", peak_rss), peak_rss
+    return rss["VmRSS:"], rss["VmHWM:"]
+
 
+# Worker process state, it lives as long as the worker process (up to max_tasks) and is reused by its tasks:
+WORKER_LOOP = None
+WORKER_BOTS = {}
+# Set by task when worker RSS is above WORKER_RSS_HIGH_WATER, worker exits after sending task result:
+WORKER_RECYCLE = False
 
-def pp_initializer(limit):
-    """Set maximum amount of memory each worker process can allocate."""
-    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
-    # resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def get_worker_loop():
+    # We use ProcessPool that runs "forkserver".
+    # It has really useful fire-and-forget ProcessPool.schedule() that only accepts sync functions.
+    # Also, there is no point in using asyncio event loop/async functions inside it.
+    # Hence, download_url_and_send() is sync function, not async.
+    # But we still want to use async Bot functions from ptb framework here.
+    # We can't use loop_main.run_in_executor(None) because it doesn't return the result.
+    # We can't use loop_main.run_until_complete() because loop is already running in our forked process.
+    # We can't use asyncio.run_coroutine_threadsafe(coro, loop_main) because it doesn't work (interferes with framework?).
+    # So we run additional loop in additional thread and just use it:
+    global WORKER_LOOP
+    if WORKER_LOOP is None:
+        WORKER_LOOP = asyncio.new_event_loop()
+        threading.Thread(target=WORKER_LOOP.run_forever, name="Additional Async Runner", daemon=True).start()
+    return WORKER_LOOP
+
+
+def run_async(coro):
+    future = asyncio.run_coroutine_threadsafe(coro, get_worker_loop())
+    return future.result()
+
+
+class TranscodeSlot:
+    """One of the transcode slots shared by worker processes, held while ffmpeg burns CPU.
+
+    Downloads and uploads are I/O-bound and run in all WORKERS at once,
+    but only TRANSCODE_WORKERS of them may transcode at the same time.
+    Slots are file locks, so slot of killed (timed out) worker is freed by OS.
+    Can be used as context manager or as yt-dlp postprocessor hook.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.lock_file = None
+
+    def acquire(self):
+        if fcntl is None or self.lock_file:
+            return
+        started = time.monotonic()
+        os.makedirs(TRANSCODE_LOCK_DIR, exist_ok=True)
+        while True:
+            for slot in range(TRANSCODE_WORKERS):
+                lock_file = open(os.path.join(TRANSCODE_LOCK_DIR, "slot{}.lock".format(slot)), "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+                self.lock_file = lock_file
+                add_stage_metric(self.metrics, "transcode_wait", "success", started)
+                return
+            time.sleep(0.5)
+
+    def release(self):
+        if self.lock_file:
+            # Closing file releases its lock:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def ydl_hook(self, progress):
+        # Hook is called for every postprocessor, but only ffmpeg ones burn CPU:
+        if progress["postprocessor"] not in TRANSCODE_POSTPROCESSORS:
+            return
+        if progress["status"] == "started":
+            self.acquire()
+        elif progress["status"] == "finished":
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.release()
+
+
+class SharedRateLimiter(BaseRateLimiter):
+    """Telegram rate limiter of worker bots, its token buckets are shared by all worker processes of the host in SQLite database.
+
+    Every request to chat takes a token from overall bucket and from bucket of this chat, groups and private chats have different budgets.
+    Requests wait for tokens instead of being sent into flood control. Flood control of chat (RetryAfter) got by one worker
+    blocks this chat for all of them, and RetryAfter is raised further to be retried by caller.
+    """
+
+    def __init__(self, path, overall_rate, group_rate, chat_rate):
+        self.path = path
+        # Bucket kind -> (tokens per second, capacity), so bursts up to capacity are sent at once:
+        self.limits = {
+            "overall": (overall_rate, overall_rate),
+            "group": (group_rate / 60, group_rate),
+            "chat": (chat_rate, chat_rate),
+        }
+        self.conn = None
+
+    async def initialize(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Autocommit mode with explicit transactions, so taking tokens is atomic between processes:
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, blocked_until REAL NOT NULL)")
+        # Buckets of chats idle for long are full anyway:
+        self.conn.execute("DELETE FROM buckets WHERE updated < ? AND blocked_until < ?", (time.time() - 3600, time.time()))
+
+    async def shutdown(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def get_buckets(self, chat_id):
+        # Returns list of (key, tokens per second, capacity), rate 0 means no limit:
+        kind = "chat"
+        if isinstance(chat_id, str) or int(chat_id) < 0:
+            kind = "group"
+        buckets = [("overall", *self.limits["overall"]), (f"chat {chat_id}", *self.limits[kind])]
+        return [bucket for bucket in buckets if bucket[1] > 0]
+
+    def take(self, buckets):
+        """Take token from every bucket and return 0, or take nothing and return seconds to wait if some bucket is empty or blocked."""
+        now = time.time()
+        wait = 0
+        states = []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, rate, capacity in buckets:
+                row = self.conn.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated, blocked_until = row or (capacity, now, 0)
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                wait = max(wait, blocked_until - now, (1 - tokens) / rate)
+                states.append((key, tokens, blocked_until))
+            if wait <= 0:
+                for key, tokens, blocked_until in states:
+                    self.conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)", (key, tokens - 1, now, blocked_until))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return max(wait, 0)
+
+    def block(self, key, seconds):
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO buckets (key, tokens, updated, blocked_until) VALUES (?, 0, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET blocked_until = MAX(blocked_until, excluded.blocked_until)",
+            (key, now, now + seconds),
+        )
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # Not a message to chat, e.g. getMe:
+            return await callback(*args, **kwargs)
+        buckets = self.get_buckets(chat_id)
+        while buckets:
+            wait = self.take(buckets)
+            if not wait:
+                break
+            logger.debug("Rate limited %s to chat %s, waiting %.2f s", endpoint, chat_id, wait)
+            await asyncio.sleep(wait)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as exc:
+            retry_after = exc.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            self.block(f"chat {chat_id}", retry_after)
+            raise
+
+
+def get_worker_bot(bot_options):
+    # We must not pass context/bot to worker, because they need to get serialized/pickled (and they cannot be).
+    # https://docs.python-telegram-bot.org/en/v20.1/telegram.bot.html
+    # So we create new Bot object once per worker process and keep its initialized connection pool alive:
+    bot_key = tuple(sorted(bot_options.items()))
+    if bot_key not in WORKER_BOTS:
+        # Workers don't go through rate limiter of main process Application, so they share their own one:
+        rate_limiter = None
+        if TG_RATE_LIMIT_DB:
+            rate_limiter = SharedRateLimiter(TG_RATE_LIMIT_DB, TG_RATE_LIMIT_OVERALL, TG_RATE_LIMIT_GROUP, TG_RATE_LIMIT_CHAT)
+        bot = ExtBot(
+            token=bot_options["token"],
+            base_url=bot_options["base_url"],
+            base_file_url=bot_options["base_file_url"],
+            local_mode=bot_options["local_mode"],
+            request=HTTPXRequest(http_version=HTTP_VERSION),
+            get_updates_request=HTTPXRequest(http_version=HTTP_VERSION),
+            rate_limiter=rate_limiter,
+        )
+        run_async(bot.initialize())
+        WORKER_BOTS[bot_key] = bot
+    return WORKER_BOTS[bot_key]
 
 
 TG_BOT_TOKEN = os.environ["TG_BOT_TOKEN"]
@@ -77,44 +351,125 @@ if "TG_BOT_API_LOCAL_MODE" in os.environ:
     TG_BOT_API_LOCAL_MODE = bool(int(os.getenv("TG_BOT_API_LOCAL_MODE", "0")))
 elif "127.0.0.1" in TG_BOT_API or "localhost" in TG_BOT_API:
     TG_BOT_API_LOCAL_MODE = True
+# Optional directory shared with local Bot API server, finished files are hardlinked (or reflinked) there instead of giving it access to DL_DIR.
+# TG_BOT_API_SPOOL_URI_DIR is the same directory as seen by Bot API server (e.g. in container), if it's mounted at different path:
+TG_BOT_API_SPOOL_DIR = os.path.expanduser(os.getenv("TG_BOT_API_SPOOL_DIR", ""))
+TG_BOT_API_SPOOL_URI_DIR = os.getenv("TG_BOT_API_SPOOL_URI_DIR", TG_BOT_API_SPOOL_DIR)
 HTTP_VERSION = "2"
 if TG_BOT_API_LOCAL_MODE:
     HTTP_VERSION = "1.1"
 TG_BOT_OWNER_CHAT_ID = int(os.getenv("TG_BOT_OWNER_CHAT_ID", "0"))
 
-CHAT_STORAGE = os.path.expanduser(os.getenv("CHAT_STORAGE", "/tmp/scdlbot.pickle"))
+CHAT_STORAGE = os.path.expanduser(os.getenv("CHAT_STORAGE", "/tmp/scdlbot.sqlite"))
+# Old PicklePersistence file, it's migrated once to CHAT_STORAGE SQLite database:
+CHAT_STORAGE_PICKLE = os.path.splitext(CHAT_STORAGE)[0] + ".pickle"
+if CHAT_STORAGE.endswith(".pickle"):
+    CHAT_STORAGE_PICKLE = CHAT_STORAGE
+    CHAT_STORAGE = os.path.splitext(CHAT_STORAGE)[0] + ".sqlite"
 DL_DIR = os.path.expanduser(os.getenv("DL_DIR", "/tmp/scdlbot"))
 BIN_PATH = os.getenv("BIN_PATH", "")
 scdl_bin = local[os.path.join(BIN_PATH, "scdl")]
 bcdl_bin = local[os.path.join(BIN_PATH, "bandcamp-dl")]
 BCDL_ENABLE = False
+# Worker processes mostly wait for network (download and upload), so there may be more of them than CPUs:
 WORKERS = int(os.getenv("WORKERS", 2))
+# Max number of worker processes running CPU-bound ffmpeg transcoding at once:
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", os.cpu_count() or 1))
+TRANSCODE_LOCK_DIR = os.path.join(DL_DIR, ".transcode")
+# Telegram limits for sending from all worker processes of the host: messages per second overall,
+# per minute to one group, per second to one private chat. Empty TG_RATE_LIMIT_DB disables limiter:
+TG_RATE_LIMIT_DB = os.path.expanduser(os.getenv("TG_RATE_LIMIT_DB", os.path.join(DL_DIR, ".ratelimit.sqlite")))
+TG_RATE_LIMIT_OVERALL = float(os.getenv("TG_RATE_LIMIT_OVERALL", "30"))
+TG_RATE_LIMIT_GROUP = float(os.getenv("TG_RATE_LIMIT_GROUP", "20"))
+TG_RATE_LIMIT_CHAT = float(os.getenv("TG_RATE_LIMIT_CHAT", "1"))
 # TODO 'fork' is prohibited, doesn't work. Maybe change to 'spawn' on all platforms
 mp_method = "forkserver"
 if platform.system() == "Windows":
     mp_method = "spawn"
+else:
+    # Forkserver imports heavy modules once, and worker processes inherit them already imported:
+    get_context(method=mp_method).set_forkserver_preload(["scdlbot.__main__", "yt_dlp", "ffmpeg", "mutagen.id3", "mutagen.mp3"])
 # https://stackoverflow.com/a/66113051
 # https://superfastpython.com/processpoolexecutor-multiprocessing-context/
 # https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
 # https://docs.python.org/3/library/concurrent.futures.html#concurrent.futures.ProcessPoolExecutor
 # EXECUTOR = concurrent.futures.ProcessPoolExecutor(max_workers=WORKERS, mp_context=get_context(method=mp_method))
-EXECUTOR = ProcessPool(initializer=pp_initializer, initargs=(MAX_MEM,), max_workers=WORKERS, max_tasks=20, context=get_context(method=mp_method))
+EXECUTOR = ProcessPool(initializer=pp_initializer, initargs=(MAX_MEM,), max_workers=WORKERS, max_tasks=WORKER_MAX_TASKS, context=get_context(method=mp_method))
 # EXECUTOR = ProcessPool(max_workers=WORKERS, max_tasks=20, context=get_context(method=mp_method))
+# Main process shared async HTTP clients (proxy -> httpx.AsyncClient) and cache of resolved short links (short link -> link):
+HTTP_CLIENTS = {}
+UNSHORTENED_URLS = {}
+UNSHORTENED_URLS_CACHE_SIZE = 10000
+# Single-flight downloads in progress: "<kind> <url>" -> list of kwargs of requests waiting for the same link:
+DOWNLOADS_IN_PROGRESS = {}
+# Fair scheduling of downloads: max jobs of one chat running at once, and how many priority jobs (private chats, commands) go per one passive group message job:
+MAX_CHAT_JOBS = int(os.getenv("MAX_CHAT_JOBS", "2"))
+PRIORITY_WEIGHT = int(os.getenv("PRIORITY_WEIGHT", "3"))
+# Admission control: new downloads are rejected if this many are waiting in queue or estimated wait is longer (in seconds), 0 to disable:
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "100"))
+MAX_QUEUE_WAIT = int(os.getenv("MAX_QUEUE_WAIT", "1800"))
+# Interval (in seconds) of updating queue position in wait messages:
+QUEUE_POSITION_INTERVAL = int(os.getenv("QUEUE_POSITION_INTERVAL", "10"))
 DL_TIMEOUT = int(os.getenv("DL_TIMEOUT", 300))
+# Janitor removes download dirs left by killed tasks and checks DL_DIR disk usage with this interval (in seconds):
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "60"))
+# New downloads are not admitted while free space on DL_DIR disk is below this (in MiB), 0 to disable:
+MIN_FREE_SPACE = int(os.getenv("MIN_FREE_SPACE", "500")) * 1024 * 1024
+# Download dirs of tasks running in this process pool, other dirs in DL_DIR are orphaned after DL_TIMEOUT:
+LIVE_DOWNLOAD_DIRS = set()
+# Optional job broker URL, e.g. "sqlite:////var/lib/scdlbot/jobs.sqlite": bot only enqueues downloads, and "scdlbot-worker" nodes run them.
+# Then WORKERS of bot is max number of jobs running on all nodes at once, and WORKERS of worker node is number of its processes.
+JOB_BROKER = os.getenv("JOB_BROKER", "")
+JOB_BROKER_POLL_INTERVAL = float(os.getenv("JOB_BROKER_POLL_INTERVAL", "1"))
+# Reserved job becomes visible to other nodes again if not acked in DL_TIMEOUT + this margin (in seconds), e.g. when node died:
+JOB_VISIBILITY_MARGIN = int(os.getenv("JOB_VISIBILITY_MARGIN", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
 CHECK_URL_TIMEOUT = int(os.getenv("CHECK_URL_TIMEOUT", 30))
 # Timeouts: https://www.python-httpx.org/advanced/
 COMMON_CONNECTION_TIMEOUT = int(os.getenv("COMMON_CONNECTION_TIMEOUT", 10))
 MAX_TG_FILE_SIZE = int(os.getenv("MAX_TG_FILE_SIZE", "45_000_000"))
 MAX_CONVERT_FILE_SIZE = int(os.getenv("MAX_CONVERT_FILE_SIZE", "80_000_000"))
+# Parts of split files are aimed at this share of MAX_TG_FILE_SIZE, because bitrate may vary:
+SPLIT_PART_SIZE_RATIO = float(os.getenv("SPLIT_PART_SIZE_RATIO", "0.95"))
+# Fit-to-limit mode: long audio is encoded at the highest bitrate keeping it in one file instead of 320k and splitting,
+# unless this bitrate is lower than FIT_MIN_BITRATE (in kbit/s):
+FIT_TO_LIMIT = bool(int(os.getenv("FIT_TO_LIMIT", "0")))
+FIT_MIN_BITRATE = int(os.getenv("FIT_MIN_BITRATE", "96"))
+# Worker uploads are retried up to this number of attempts: after RetryAfter in time told by Telegram,
+# after network errors and timeouts with exponential backoff (base and max in seconds) and jitter, not retried after permanent errors:
+TG_SEND_MAX_ATTEMPTS = int(os.getenv("TG_SEND_MAX_ATTEMPTS", "5"))
+TG_SEND_BACKOFF_BASE = float(os.getenv("TG_SEND_BACKOFF_BASE", "2"))
+TG_SEND_BACKOFF_MAX = float(os.getenv("TG_SEND_BACKOFF_MAX", "60"))
 NO_FLOOD_CHAT_IDS = list(map(int, os.getenv("NO_FLOOD_CHAT_IDS", "0").split(",")))
+# Pending "ask" mode questions are forgotten after this time (in seconds), there are at most MAX_CHAT_ASKS of them per chat:
+ASK_TTL = int(os.getenv("ASK_TTL", str(24 * 60 * 60)))
+MAX_CHAT_ASKS = int(os.getenv("MAX_CHAT_ASKS", "20"))
+ASK_SWEEP_INTERVAL = int(os.getenv("ASK_SWEEP_INTERVAL", "600"))
+# Delete messages with buttons of forgotten questions too:
+ASK_DELETE_STALE = bool(int(os.getenv("ASK_DELETE_STALE", "0")))
+# Sent Telegram file_ids cache (kept in separate table of CHAT_STORAGE database), max entries and max entry age in seconds:
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "10000"))
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", str(30 * 24 * 60 * 60)))
 COOKIES_FILE = os.getenv("COOKIES_FILE", None)
+# Cookies from URL are refreshed in background with this interval (in seconds) and materialized to local file for workers:
+COOKIES_REFRESH_INTERVAL = int(os.getenv("COOKIES_REFRESH_INTERVAL", "600"))
+COOKIES_CACHE_FILE = os.path.expanduser(os.getenv("COOKIES_CACHE_FILE", os.path.join(DL_DIR, "cookies.txt")))
+# Conditional request validators of the last fetched cookies:
+COOKIES_STATE = {"etag": None, "last_modified": None}
 PROXIES = []
 if "PROXIES" in os.environ:
     PROXIES = [None if x == "direct" else x for x in os.getenv("PROXIES").split(",")]
 SOURCE_IPS = []
 if "SOURCE_IPS" in os.environ:
     SOURCE_IPS = os.getenv("SOURCE_IPS").split(",")
-BLACKLIST_TELEGRAM_DOMAINS = [
+# Proxy or source IP is skipped for EGRESS_COOLDOWN seconds after this number of failed downloads in a row, and then gets one trial download:
+EGRESS_FAILURE_THRESHOLD = int(os.getenv("EGRESS_FAILURE_THRESHOLD", "3"))
+EGRESS_COOLDOWN = int(os.getenv("EGRESS_COOLDOWN", "300"))
+# Proxy or source IP blocked by site (region restriction) is not used for this site for this time in seconds:
+EGRESS_SITE_BLOCK_TTL = int(os.getenv("EGRESS_SITE_BLOCK_TTL", "3600"))
+# Sites which block proxies and source IPs by region or as bots, their HTTP 403/429 errors are taken for such block:
+EGRESS_BLOCKING_SITES = os.getenv("EGRESS_BLOCKING_SITES", "youtube,instagram,tiktok,twitter").split(",")
+BLACKLIST_TELEGRAM_DOMAINS = {
     "telegram.org",
     "telegram.me",
     "t.me",
@@ -127,7 +482,7 @@ BLACKLIST_TELEGRAM_DOMAINS = [
     "telesco.pe",
     "contest.com",
     "contest.dev",
-]
+}
 WHITELIST_DOMAINS = {}
 if "WHITELIST_DOMAINS" in os.environ:
     WHITELIST_DOMAINS = set(x for x in os.getenv("WHITELIST_DOMAINS").split(","))
@@ -161,6 +516,12 @@ WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", None)
 METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
 REGISTRY = prometheus_client.CollectorRegistry()
+STARTUP_SECONDS = prometheus_client.Gauge(
+    "startup_seconds",
+    "Value: startup_seconds",
+    labelnames=["stage"],
+    registry=REGISTRY,
+)
 EXECUTOR_TASKS_REMAINING = prometheus_client.Gauge(
     "executor_tasks_remaining",
     "Value: executor_tasks_remaining",
@@ -172,6 +533,74 @@ BOT_REQUESTS = prometheus_client.Counter(
     labelnames=["type", "chat_type", "mode"],
     registry=REGISTRY,
 )
+# Worker processes return their metrics with task result, and we collect them here in main process:
+DOWNLOAD_JOBS = prometheus_client.Counter(
+    "download_jobs_total",
+    "Value: download_jobs_total",
+    labelnames=["site", "outcome"],
+    registry=REGISTRY,
+)
+STAGE_DURATION = prometheus_client.Histogram(
+    "stage_duration_seconds",
+    "Value: stage_duration_seconds",
+    labelnames=["stage", "site", "outcome"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, float("inf")),
+    registry=REGISTRY,
+)
+TRANSFERRED_BYTES = prometheus_client.Counter(
+    "transferred_bytes_total",
+    "Value: transferred_bytes_total",
+    labelnames=["direction", "site"],
+    registry=REGISTRY,
+)
+UPLOAD_SPEED = prometheus_client.Histogram(
+    "upload_speed_bytes_per_second",
+    "Value: upload_speed_bytes_per_second",
+    labelnames=["site"],
+    buckets=tuple(mb * 1000 * 1000 for mb in (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100)) + (float("inf"),),
+    registry=REGISTRY,
+)
+WORKER_PEAK_RSS = prometheus_client.Histogram(
+    "worker_task_peak_rss_bytes",
+    "Value: worker_task_peak_rss_bytes",
+    labelnames=["site"],
+    buckets=tuple(mib * 1024 * 1024 for mib in (64, 128, 256, 512, 768, 1024, 1536, 2048, 4096)) + (float("inf"),),
+    registry=REGISTRY,
+)
+WORKER_TELEGRAM_ERRORS = prometheus_client.Counter(
+    "worker_telegram_errors_total",
+    "Value: worker_telegram_errors_total",
+    labelnames=["error", "action"],
+    registry=REGISTRY,
+)
+EGRESS_SUCCESS_RATE = prometheus_client.Gauge(
+    "egress_success_rate",
+    "Value: egress_success_rate",
+    labelnames=["kind", "egress"],
+    registry=REGISTRY,
+)
+EGRESS_RETRIES = prometheus_client.Counter(
+    "egress_retries_total",
+    "Value: egress_retries_total",
+    labelnames=["site", "error"],
+    registry=REGISTRY,
+)
+WORKER_RECYCLES = prometheus_client.Counter(
+    "worker_recycles_total",
+    "Value: worker_recycles_total",
+    registry=REGISTRY,
+)
+DL_DIR_BYTES = prometheus_client.Gauge(
+    "dl_dir_bytes",
+    "Value: dl_dir_bytes",
+    labelnames=["kind"],
+    registry=REGISTRY,
+)
+ORPHANED_DIRS_REMOVED = prometheus_client.Counter(
+    "orphaned_dirs_removed_total",
+    "Value: orphaned_dirs_removed_total",
+    registry=REGISTRY,
+)
 
 # Logging:
 logging_handlers = []
@@ -208,11 +637,15 @@ logger = logging.getLogger(__name__)
 # Systemd watchdog monitoring:
 SYSTEMD_NOTIFIER = sdnotify.SystemdNotifier()
 
+# Messages forwarded from bot itself are skipped, bot username is added in post_init:
+FORWARDED_FROM_BOT = filters.ForwardedFrom()
+FIRST_UPDATE_SEEN = False
+
 # Randomize User-Agent:
 # https://github.com/intoli/user-agents/tree/main/src
 ## https://user-agents.net/download
 ## https://user-agents.net/my-user-agent
-UA = UserAgent(browsers=["Google", "Chrome", "Firefox", "Edge"], platforms=["desktop"], os=["Windows", "Linux", "Ubuntu"])
+UA = None
 
 
 # Text constants from resources:
@@ -228,10 +661,13 @@ DL_TIMEOUT_TEXT = get_response_text("dl_timeout.txt").format(DL_TIMEOUT // 60)
 WAIT_BIT_TEXT = [get_response_text("wait_bit.txt"), get_response_text("wait_beat.txt"), get_response_text("wait_beet.txt")]
 NO_URLS_TEXT = get_response_text("no_urls.txt")
 FAILED_TEXT = get_response_text("failed.txt")
+TOO_LARGE_TEXT = get_response_text("too_large.txt")
 REGION_RESTRICTION_TEXT = get_response_text("region_restriction.txt")
 DIRECT_RESTRICTION_TEXT = get_response_text("direct_restriction.txt")
 LIVE_RESTRICTION_TEXT = get_response_text("live_restriction.txt")
 OLD_MSG_TEXT = get_response_text("old_msg.txt")
+BUSY_TEXT = get_response_text("busy.txt")
+QUEUE_POSITION_TEXT = get_response_text("queue_position.txt")
 # RANT_TEXT_PRIVATE = "Read /help to learn how to use me"
 # RANT_TEXT_PUBLIC = f"[Start me in PM to read help and learn how to use me](t.me/{TG_BOT_USERNAME}?start=1)"
 
@@ -249,11 +685,49 @@ DOMAIN_TT = "tiktok.com"
 DOMAIN_IG = "instagram.com"
 DOMAIN_TW = "twitter.com"
 DOMAIN_TWX = "x.com"
-DOMAINS_STRINGS = [DOMAIN_SC, DOMAIN_SC_ON, DOMAIN_SC_API, DOMAIN_SC_GOOGL, DOMAIN_BC, DOMAIN_YT, DOMAIN_YT_BE, DOMAIN_YMR, DOMAIN_YMC, DOMAIN_TT, DOMAIN_IG, DOMAIN_TW, DOMAIN_TWX]
-DOMAINS = [rf"^(?:[^\s]+\.)?{re.escape(domain_string)}$" for domain_string in DOMAINS_STRINGS]
+# Known domains (and their subdomains) to sites, matched by the longest domain suffix, so e.g. music.yandex.com is not x.com:
+SITES = {
+    DOMAIN_SC: "soundcloud",
+    DOMAIN_SC_ON: "soundcloud",
+    DOMAIN_SC_API: "soundcloud",
+    DOMAIN_SC_GOOGL: "soundcloud",
+    DOMAIN_BC: "bandcamp",
+    DOMAIN_YT: "youtube",
+    DOMAIN_YT_BE: "youtube",
+    DOMAIN_YMR: "yandex_music",
+    DOMAIN_YMC: "yandex_music",
+    DOMAIN_TT: "tiktok",
+    DOMAIN_IG: "instagram",
+    DOMAIN_TW: "twitter",
+    DOMAIN_TWX: "twitter",
+}
+VIDEO_SITES = ["tiktok", "instagram", "twitter"]
 
 AUDIO_FORMATS = ["mp3"]
 VIDEO_FORMATS = ["m4a", "mp4", "webm"]
+# Subdirectory of job download dir for converted files and split parts:
+WORK_DIR_NAME = ".work"
+# Files which are still being written by downloaders:
+PARTIAL_FILE_EXTS = [".part", ".tmp", ".ytdl", ".temp"]
+# yt-dlp postprocessors which run ffmpeg, by their pp_key() (FFmpeg prefix is stripped there):
+TRANSCODE_POSTPROCESSORS = ["ExtractAudio", "Metadata", "EmbedThumbnail", "CopyStream"]
+# Lowercase parts of downloader error messages caused by proxy or source IP, not by link itself:
+EGRESS_REGION_ERRORS = ["geo restrict", "not available in your country", "not available from your location", "available in your country", "in your region"]
+# Only transport errors count here, HTTP errors are usually caused by link itself:
+EGRESS_NETWORK_ERRORS = [
+    "unable to connect to proxy",
+    "cannot connect to proxy",
+    "tunnel connection failed",
+    "connection refused",
+    "connection reset",
+    "network is unreachable",
+    "temporary failure in name resolution",
+    "name or service not known",
+]
+# HTTP errors which mean that site blocked proxy or source IP, but only for sites known to block them:
+EGRESS_BLOCK_ERRORS = ["http error 403", "http error 429", "not a bot"]
+# Standard MPEG-1 Layer III bitrates in kbit/s, highest first:
+MP3_BITRATES = [320, 256, 224, 192, 160, 128, 112, 96, 80, 64, 56, 48, 40, 32]
 
 
 # TODO get rid of these dumb exceptions:
@@ -282,10 +756,452 @@ class FileSentPartiallyError(Exception):
         self.sent_audio_ids = sent_audio_ids
 
 
+class DownloadScheduler:
+    """Admit download jobs to EXECUTOR fairly instead of plain FIFO.
+
+    Jobs wait in per-chat queues of two priority tiers. Tiers are served by weighted round-robin,
+    chats inside tier are served by round-robin, and each chat may have limited number of jobs running.
+    Only `max_jobs` jobs are passed to EXECUTOR at once, so its own FIFO queue stays empty.
+    New jobs are not admitted if there are already `max_pending` jobs waiting or estimated wait is longer than `max_wait` seconds.
+    While `paused` (e.g. disk is full), no jobs are admitted or started.
+    """
+
+    def __init__(self, max_jobs, max_chat_jobs, priority_weight, max_pending=0, max_wait=0):
+        self.max_jobs = max_jobs
+        self.max_chat_jobs = max_chat_jobs
+        self.priority_weight = priority_weight
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.paused = False
+        # Priority tier -> chat_id -> deque of jobs, chats in round-robin order:
+        self.queues = {True: collections.OrderedDict(), False: collections.OrderedDict()}
+        self.chat_jobs = collections.Counter()
+        self.jobs = 0
+        self.priority_turns = 0
+        # Moving average of job run time in seconds, used for wait estimation:
+        self.job_time = 60.0
+        # Jobs that were shown queue position and were started since, their wait messages need to be updated:
+        self.started_jobs = []
+
+    def put(self, chat_id, priority, submit, wait_message_id=None):
+        # submit() is called in main loop when job is admitted and must return pebble future:
+        job = {"chat_id": chat_id, "submit": submit, "wait_message_id": wait_message_id, "position": None}
+        self.queues[priority].setdefault(chat_id, collections.deque()).append(job)
+        self.pump()
+
+    def pending(self):
+        return sum(len(chat_queue) for queue in self.queues.values() for chat_queue in queue.values())
+
+    def estimate_wait(self, position):
+        # Jobs ahead are run by max_jobs workers in parallel:
+        if self.jobs < self.max_jobs:
+            return 0
+        return self.job_time * math.ceil(position / self.max_jobs)
+
+    def admit(self):
+        if self.paused:
+            return False
+        pending = self.pending()
+        if self.max_pending and pending >= self.max_pending:
+            return False
+        if self.max_wait and self.estimate_wait(pending + 1) > self.max_wait:
+            return False
+        return True
+
+    def pump(self):
+        loop_main = asyncio.get_running_loop()
+        while self.jobs < self.max_jobs and not self.paused:
+            job = self.pick()
+            if not job:
+                break
+            chat_id = job["chat_id"]
+            self.chat_jobs[chat_id] += 1
+            self.jobs += 1
+            if job["position"]:
+                self.started_jobs.append(job)
+            try:
+                future = job["submit"]()
+            except Exception:
+                logger.error("Could not submit download job", exc_info=True)
+                self.release(chat_id)
+                continue
+            # Done callback is run in pebble thread, so we release job slot in the main loop:
+            future.add_done_callback(lambda _, chat_id=chat_id, started=time.monotonic(): loop_main.call_soon_threadsafe(self.release, chat_id, started))
+
+    def release(self, chat_id, started=None):
+        self.jobs -= 1
+        self.chat_jobs[chat_id] -= 1
+        if not self.chat_jobs[chat_id]:
+            del self.chat_jobs[chat_id]
+        if started:
+            self.job_time = 0.8 * self.job_time + 0.2 * (time.monotonic() - started)
+        self.pump()
+
+    def pick(self):
+        job, self.priority_turns = self.pick_from(self.queues, self.chat_jobs, self.priority_turns)
+        return job
+
+    def pick_from(self, queues, chat_jobs, priority_turns):
+        # Picks next job from queues (modifying them), returns job and new priority_turns:
+        tiers = [True, False]
+        if priority_turns >= self.priority_weight:
+            tiers = [False, True]
+        for priority in tiers:
+            queue = queues[priority]
+            for chat_id in list(queue):
+                if chat_jobs[chat_id] >= self.max_chat_jobs:
+                    continue
+                chat_queue = queue.pop(chat_id)
+                job = chat_queue.popleft()
+                if chat_queue:
+                    # Chat goes to the end of round-robin order:
+                    queue[chat_id] = chat_queue
+                return job, (priority_turns + 1 if priority else 0)
+        return None, priority_turns
+
+    def ordered_jobs(self):
+        # Expected order of pending jobs, per-chat running jobs limit is ignored here:
+        queues = {priority: collections.OrderedDict((chat_id, collections.deque(chat_queue)) for chat_id, chat_queue in queue.items()) for priority, queue in self.queues.items()}
+        chat_jobs = collections.Counter()
+        priority_turns = self.priority_turns
+        jobs = []
+        while True:
+            job, priority_turns = self.pick_from(queues, chat_jobs, priority_turns)
+            if not job:
+                return jobs
+            jobs.append(job)
+
+
+class JobBroker(ABC):
+    """Queue of download jobs between bot and worker nodes.
+
+    Bot puts jobs and collects their results, worker nodes reserve jobs and ack them with results.
+    Reserved job is hidden from other nodes for visibility_timeout seconds,
+    after that it's delivered again or, after max_attempts, finished with "timeout" error.
+    Subclass it and add to JOB_BROKERS to use a real broker.
+    """
+
+    @abstractmethod
+    def put(self, job_id, kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def reserve(self, worker_id, visibility_timeout, max_attempts):
+        """Return (job_id, kwargs) of the oldest visible job, or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ack(self, job_id, result):
+        raise NotImplementedError
+
+    @abstractmethod
+    def fail(self, job_id, error):
+        """Finish job with error: "timeout", "memory" or "error"."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def collect(self, max_attempts):
+        """Return and forget finished jobs as (job_id, result, error) list."""
+        raise NotImplementedError
+
+
+class SqliteJobBroker(JobBroker):
+    """Local broker in SQLite database file, it's shared by bot and worker nodes on one host or network filesystem with working locks."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kwargs TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "visible_at REAL NOT NULL, worker TEXT, result TEXT, error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, visible_at)")
+
+    def connect(self):
+        # Autocommit mode with explicit transactions, so reserve is atomic between nodes:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def put(self, job_id, kwargs):
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("INSERT INTO jobs (id, kwargs, state, visible_at) VALUES (?, ?, 'queued', ?)", (job_id, json.dumps(kwargs), time.time()))
+
+    def expire(self, conn, max_attempts):
+        now = time.time()
+        conn.execute("UPDATE jobs SET state = 'done', error = 'timeout' WHERE state = 'reserved' AND visible_at <= ? AND attempts >= ?", (now, max_attempts))
+        conn.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE state = 'reserved' AND visible_at <= ?", (now,))
+
+    def reserve(self, worker_id, visibility_timeout, max_attempts):
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.expire(conn, max_attempts)
+                row = conn.execute("SELECT id, kwargs FROM jobs WHERE state = 'queued' ORDER BY rowid LIMIT 1").fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'reserved', attempts = attempts + 1, visible_at = ?, worker = ? WHERE id = ?",
+                        (time.time() + visibility_timeout, worker_id, row[0]),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if row:
+            return row[0], json.loads(row[1])
+        return None
+
+    def ack(self, job_id, result):
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("UPDATE jobs SET state = 'done', result = ? WHERE id = ? AND state != 'done'", (json.dumps(result), job_id))
+
+    def fail(self, job_id, error):
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("UPDATE jobs SET state = 'done', error = ? WHERE id = ? AND state != 'done'", (error, job_id))
+
+    def collect(self, max_attempts):
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.expire(conn, max_attempts)
+                rows = conn.execute("SELECT id, result, error FROM jobs WHERE state = 'done'").fetchall()
+                conn.execute("DELETE FROM jobs WHERE state = 'done'")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [(job_id, json.loads(result) if result else None, error) for job_id, result, error in rows]
+
+
+# Job broker URL scheme -> JobBroker class:
+JOB_BROKERS = {"sqlite": SqliteJobBroker}
+
+
+def get_job_broker():
+    if not JOB_BROKER:
+        return None
+    scheme, _, path = JOB_BROKER.partition("://")
+    return JOB_BROKERS[scheme](os.path.expanduser(path))
+
+
+class BrokerJobs:
+    """Futures of jobs sent to job broker, they are resolved by poll() in main process."""
+
+    # Job errors reported by worker nodes -> exceptions expected by download_done():
+    ERRORS = {"timeout": TimeoutError, "memory": MemoryError}
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.futures = {}
+
+    def submit(self, kwargs):
+        job_id = str(uuid4())
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        self.broker.put(job_id, kwargs)
+        self.futures[job_id] = future
+        return future
+
+    def poll(self):
+        for job_id, result, error in self.broker.collect(JOB_MAX_ATTEMPTS):
+            # Jobs of previous bot runs have no futures:
+            future = self.futures.pop(job_id, None)
+            if future is None:
+                continue
+            if error:
+                future.set_exception(self.ERRORS.get(error, Exception)(error))
+            else:
+                future.set_result(result)
+
+
+class EgressSelector:
+    """Health-weighted choice of egress (proxy or source IP) for downloads instead of uniform random choice.
+
+    Egress weight is its success rate divided by its usual download time (both are moving averages).
+    After `failure_threshold` failed downloads in a row egress circuit is open: it's skipped for `cooldown` seconds,
+    then it gets one trial download per `cooldown`, and success closes the circuit.
+    Picks with `trial=False` (e.g. for link checking, which results are not recorded) never use egress with open circuit.
+    Egress blocked by some site (region restriction) is skipped for this site for `site_block_ttl` seconds.
+    """
+
+    def __init__(self, kind, egresses, failure_threshold, cooldown, site_block_ttl):
+        self.kind = kind
+        self.egresses = egresses
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.site_block_ttl = site_block_ttl
+        self.health = {egress: {"success_rate": 1.0, "seconds": None, "failures": 0, "open_until": 0} for egress in egresses}
+        # (egress, site) -> monotonic time until which site blocks egress:
+        self.site_blocks = {}
+
+    @staticmethod
+    def get_label(egress):
+        # Proxy credentials must not get to metrics:
+        if egress is None:
+            return "direct"
+        if "://" in egress:
+            egress_url = URL(egress)
+            return f"{egress_url.scheme}://{egress_url.host}:{egress_url.port}"
+        return egress
+
+    def is_available(self, egress, site, now):
+        if self.site_blocks.get((egress, site), 0) > now:
+            return False
+        return self.health[egress]["open_until"] <= now
+
+    def get_weight(self, egress):
+        health = self.health[egress]
+        # Egress without downloads yet is taken for average one:
+        known_seconds = [health["seconds"] for health in self.health.values() if health["seconds"]]
+        seconds = health["seconds"] or (sum(known_seconds) / len(known_seconds) if known_seconds else 1)
+        return max(health["success_rate"], 0.01) / max(seconds, 1)
+
+    def pick(self, site=None, exclude=(), trial=True):
+        if not self.egresses:
+            return None
+        now = time.monotonic()
+        candidates = [egress for egress in self.egresses if egress not in exclude] or list(self.egresses)
+        available = [egress for egress in candidates if self.is_available(egress, site, now)]
+        if not trial:
+            available = [egress for egress in available if self.health[egress]["failures"] < self.failure_threshold]
+        if not available:
+            # Everything seems broken, but we still try something:
+            return random.choice(candidates)
+        egress = random.choices(available, weights=[self.get_weight(egress) for egress in available])[0]
+        health = self.health[egress]
+        if trial and health["failures"] >= self.failure_threshold:
+            # Half-open circuit: this is the trial download, next one is after cooldown again:
+            health["open_until"] = now + self.cooldown
+        return egress
+
+    def record(self, egress, site, ok, seconds=None, error=None):
+        if egress not in self.health:
+            return
+        now = time.monotonic()
+        health = self.health[egress]
+        health["success_rate"] = 0.8 * health["success_rate"] + 0.2 * ok
+        if ok:
+            health["failures"] = 0
+            health["open_until"] = 0
+            if seconds:
+                health["seconds"] = seconds if health["seconds"] is None else 0.8 * health["seconds"] + 0.2 * seconds
+        else:
+            health["failures"] += 1
+            if health["failures"] >= self.failure_threshold:
+                if health["failures"] == self.failure_threshold:
+                    logger.warning("Circuit of %s %s is open after %s failures", self.kind, self.get_label(egress), health["failures"])
+                health["open_until"] = now + self.cooldown
+            if error == "region":
+                self.site_blocks[(egress, site)] = now + self.site_block_ttl
+        EGRESS_SUCCESS_RATE.labels(kind=self.kind, egress=self.get_label(egress)).set(health["success_rate"])
+
+
+BROKER_JOBS = None
+if JOB_BROKER:
+    BROKER_JOBS = BrokerJobs(get_job_broker())
+
+SCHEDULER = DownloadScheduler(max_jobs=WORKERS, max_chat_jobs=MAX_CHAT_JOBS, priority_weight=PRIORITY_WEIGHT, max_pending=MAX_QUEUE, max_wait=MAX_QUEUE_WAIT)
+PROXY_SELECTOR = EgressSelector("proxy", PROXIES, EGRESS_FAILURE_THRESHOLD, EGRESS_COOLDOWN, EGRESS_SITE_BLOCK_TTL)
+SOURCE_IP_SELECTOR = EgressSelector("source_ip", SOURCE_IPS, EGRESS_FAILURE_THRESHOLD, EGRESS_COOLDOWN, EGRESS_SITE_BLOCK_TTL)
+
+
 def get_random_wait_text():
     return random.choice(WAIT_BIT_TEXT)
 
 
+class SiteInfo(NamedTuple):
+    # Known site name or None:
+    site: Optional[str]
+    # Matched known domain or None:
+    domain: Optional[str]
+    # Supported link kind on known site (track, set, playlist, video, reel, short) or None if link is not supported:
+    kind: Optional[str]
+    path_parts_num: int
+
+
+def match_domain_suffix(host, domains):
+    # Hash lookups of host suffixes from the longest to the shortest, e.g. m.soundcloud.com, soundcloud.com, com:
+    labels = host.lower().rstrip(".").split(".")
+    for i in range(len(labels)):
+        suffix = ".".join(labels[i:])
+        if suffix in domains:
+            return suffix
+    return None
+
+
+def classify_url(url):
+    path_parts = [part for part in url.path_parts if part]
+    path_parts_num = len(path_parts)
+    domain = match_domain_suffix(url.host, SITES)
+    site = SITES.get(domain)
+    kind = None
+    if domain in [DOMAIN_SC_ON, DOMAIN_SC_GOOGL]:
+        kind = "short"
+    elif domain == DOMAIN_SC_API:
+        # SoundCloud widget pages:
+        kind = "track"
+    elif site == "soundcloud":
+        # SoundCloud: tracks, sets and widget pages, no /you/ pages
+        # TODO support private sets URLs that have 5 parts
+        if (2 <= path_parts_num <= 4) and ("you" not in path_parts) and ("likes" not in path_parts):
+            kind = "set" if "sets" in path_parts else "track"
+    elif site == "bandcamp":
+        # Bandcamp: tracks and albums
+        if path_parts_num == 2:
+            kind = "set" if path_parts[0] == "album" else "track"
+    elif domain == DOMAIN_YT_BE:
+        kind = "track"
+    elif site == "youtube":
+        # YouTube: videos and playlists
+        if "playlist" in url.path:
+            kind = "playlist"
+        elif "watch" in url.path:
+            kind = "track"
+    elif site == "yandex_music":
+        kind = "track" if "track" in path_parts else "set"
+    elif site == "tiktok":
+        kind = "video"
+    elif site == "instagram":
+        # Instagram: videos, reels
+        if path_parts_num >= 2:
+            kind = "reel"
+    elif site == "twitter":
+        # Twitter: videos
+        if path_parts_num == 3:
+            kind = "video"
+    return SiteInfo(site=site, domain=domain, kind=kind, path_parts_num=path_parts_num)
+
+
+def get_download_kind(host):
+    # TikTok, Instagram and Twitter links are downloaded and sent as videos, everything else as audios:
+    if SITES.get(match_domain_suffix(host, SITES)) in VIDEO_SITES:
+        return "video"
+    return "audio"
+
+
+def get_caption_full(caption_part=None, caption=None):
+    if caption:
+        if caption_part:
+            return caption_part + " | " + caption
+        return caption
+    if caption_part:
+        return caption_part
+    return ""
+
+
+def get_cached_file_ids(persistence, url, kind):
+    return persistence.get_file_ids(f"{kind} {url}")
+
+
+def put_cached_file_ids(persistence, url, kind, items):
+    persistence.put_file_ids(f"{kind} {url}", items)
+
+
+def drop_cached_file_ids(persistence, url, kind):
+    persistence.drop_file_ids(f"{kind} {url}")
+
+
 def get_link_text(urls):
     link_text = ""
     for i, url in enumerate(urls):
@@ -338,17 +1254,17 @@ def chat_allowed(chat_id):
 
 def url_valid_and_allowed(url, allow_unknown_sites=False):
     host = url.host
-    if host in BLACKLIST_TELEGRAM_DOMAINS:
+    if match_domain_suffix(host, BLACKLIST_TELEGRAM_DOMAINS):
         return False
     if WHITELIST_DOMAINS:
-        if host not in WHITELIST_DOMAINS:
+        if not match_domain_suffix(host, WHITELIST_DOMAINS):
             return False
     if BLACKLIST_DOMAINS:
-        if host in BLACKLIST_DOMAINS:
+        if match_domain_suffix(host, BLACKLIST_DOMAINS):
             return False
     if allow_unknown_sites:
         return True
-    if any((re.match(domain, host) for domain in DOMAINS)):
+    if match_domain_suffix(host, SITES):
         return True
     else:
         return False
@@ -387,6 +1303,328 @@ async def settings_command_callback(update: Update, context: ContextTypes.DEFAUL
     await context.bot.send_message(chat_id=chat_id, parse_mode="Markdown", reply_markup=get_settings_inline_keyboard(context.chat_data), text=SETTINGS_TEXT)
 
 
+async def check_cached_file_ids(bot, items):
+    # Telegram forgets file_ids sometimes, getFile tells it without posting anything:
+    for item in items:
+        try:
+            await bot.get_file(item["file_id"])
+        except BadRequest as exc:
+            # File is known, it's just too big to be downloaded by bots:
+            if "too big" not in exc.message.lower():
+                return False
+        except TelegramError:
+            return False
+    return True
+
+
+async def send_cached_file_ids(bot, chat_id, items, flood=False, reply_to_message_id=None, sent_items=None):
+    reply_to_message_id_send = None
+    if flood:
+        reply_to_message_id_send = reply_to_message_id
+    for item in items:
+        caption_full = get_caption_full(item["caption_part"], item["caption"] if flood else None)
+        if item["type"] == "video":
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_VIDEO)
+            await bot.send_video(
+                chat_id=chat_id, reply_to_message_id=reply_to_message_id_send, video=item["file_id"], supports_streaming=True, caption=caption_full, parse_mode="Markdown"
+            )
+        else:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_VOICE)
+            await bot.send_audio(chat_id=chat_id, reply_to_message_id=reply_to_message_id_send, audio=item["file_id"], caption=caption_full, parse_mode="Markdown")
+        if sent_items is not None:
+            sent_items.append(item)
+
+
+async def dl_url(context: ContextTypes.DEFAULT_TYPE, kwargs, priority=False):
+    # Returns True if download job was scheduled and False if files were already sent from cache.
+    url = kwargs["url"]
+    chat_id = kwargs["chat_id"]
+    kind = get_download_kind(URL(url).host)
+    persistence = context.application.persistence
+    cached_items = get_cached_file_ids(persistence, url, kind)
+    if cached_items and len(cached_items) > 1 and not await check_cached_file_ids(context.bot, cached_items):
+        # Outdated file_ids of playlist are found before its first files are posted, so downloading it again won't duplicate them:
+        logger.debug("Cached file_ids are outdated: %s", url)
+        drop_cached_file_ids(persistence, url, kind)
+        cached_items = None
+    if cached_items:
+        sent_items = []
+        try:
+            await send_cached_file_ids(context.bot, chat_id, cached_items, flood=kwargs["flood"], reply_to_message_id=kwargs["reply_to_message_id"], sent_items=sent_items)
+            logger.debug("Sent from file_id cache: %s", url)
+            return False
+        except TelegramError:
+            # file_id may be outdated, so we forget it and download again:
+            logger.debug("Sending from file_id cache failed: %s", url)
+            drop_cached_file_ids(persistence, url, kind)
+            if sent_items:
+                # Downloading again would post already sent files twice, so we just tell that the rest failed:
+                try:
+                    await context.bot.send_message(chat_id=chat_id, reply_to_message_id=kwargs["reply_to_message_id"], text=FAILED_TEXT, parse_mode="Markdown")
+                except TelegramError:
+                    pass
+                return False
+
+    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.RECORD_VOICE)
+    download_key = f"{kind} {url}"
+    if download_key in DOWNLOADS_IN_PROGRESS:
+        # Same link is already being downloaded for another request, so we just wait for its file_ids:
+        logger.debug("Subscribed to download in progress: %s", url)
+        DOWNLOADS_IN_PROGRESS[download_key].append(kwargs)
+    elif not SCHEDULER.admit():
+        # Shed load early instead of keeping users waiting for DL_TIMEOUT:
+        logger.debug("Download rejected, queue is full: %s", url)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=kwargs["reply_to_message_id"],
+            text=BUSY_TEXT.format(max(1, round(SCHEDULER.estimate_wait(SCHEDULER.pending()) / 60))),
+            parse_mode="Markdown",
+        )
+        return False
+    else:
+        schedule_download(context.bot, persistence, kwargs, kind, priority)
+    return True
+
+
+def schedule_download(bot, persistence, kwargs, kind, priority=False):
+    DOWNLOADS_IN_PROGRESS[f"{kind} {kwargs['url']}"] = []
+    loop_main = asyncio.get_running_loop()
+    queued = time.monotonic()
+
+    def download_done_callback(future):
+        # Done callback may be run in pebble thread, so we continue in the main loop:
+        asyncio.run_coroutine_threadsafe(download_done(bot, persistence, kwargs, kind, future), loop_main)
+
+    def submit():
+        site = get_site_label(kwargs["url"])
+        STAGE_DURATION.labels(stage="queue", site=site, outcome="success").observe(time.monotonic() - queued)
+        if "egress_retry" not in kwargs:
+            # First attempt goes through the healthiest egress for its site, and may be retried once on another one:
+            kwargs["proxy"] = PROXY_SELECTOR.pick(site) if PROXIES else kwargs["proxy"]
+            kwargs["source_ip"] = SOURCE_IP_SELECTOR.pick(site) if SOURCE_IPS else kwargs["source_ip"]
+            kwargs["egress_retry"] = len(PROXIES) > 1 or len(SOURCE_IPS) > 1
+        try:
+            if BROKER_JOBS:
+                future = BROKER_JOBS.submit(kwargs)
+            else:
+                future = submit_download(kwargs)
+        except Exception as exc:
+            # Pool is not running, broker database is locked or disk is full, but leader and subscribers still get their reply:
+            logger.error("Could not submit download job: %s", kwargs["url"], exc_info=True)
+            future = concurrent.futures.Future()
+            future.set_exception(exc)
+        future.add_done_callback(download_done_callback)
+        return future
+
+    SCHEDULER.put(kwargs["chat_id"], priority, submit, wait_message_id=kwargs["wait_message_id"])
+
+
+def submit_download(kwargs):
+    # Run heavy task in separate process, "fire and forget":
+    # EXECUTOR.submit(download_url_and_send, **kwargs)
+    # Download dir is known here, so it's removed even if worker is killed before its own cleanup:
+    download_dir = os.path.join(DL_DIR, str(uuid4()))
+    LIVE_DOWNLOAD_DIRS.add(download_dir)
+    try:
+        future = EXECUTOR.schedule(download_url_and_send, kwargs=dict(kwargs, download_dir=download_dir), timeout=DL_TIMEOUT)
+    except Exception:
+        LIVE_DOWNLOAD_DIRS.discard(download_dir)
+        raise
+    future.add_done_callback(count_worker_recycle)
+    future.add_done_callback(functools.partial(release_download_dir, download_dir))
+    return future
+
+
+def release_download_dir(download_dir, future):
+    # Runs in pebble thread. Worker removes its dir by itself, unless it was killed on timeout or died:
+    if future.exception() is not None:
+        remove_download_dir(download_dir)
+    LIVE_DOWNLOAD_DIRS.discard(download_dir)
+
+
+def remove_download_dir(download_dir):
+    shutil.rmtree(download_dir, ignore_errors=True)
+    if os.path.exists(download_dir + ".cookies.txt"):
+        os.remove(download_dir + ".cookies.txt")
+
+
+def is_download_dir_name(name):
+    # Download dirs and their cookies files are named by uuid4, other DL_DIR entries are not ours to remove:
+    try:
+        UUID(name.removesuffix(".cookies.txt"))
+    except ValueError:
+        return False
+    return True
+
+
+def sweep_download_dirs():
+    """Remove orphaned download dirs and spool dirs, return (used, free) bytes of DL_DIR."""
+    orphaned_before = time.time() - DL_TIMEOUT - JOB_VISIBILITY_MARGIN
+    live_dirs = set(LIVE_DOWNLOAD_DIRS)
+    sweep_dirs = [DL_DIR]
+    if TG_BOT_API_SPOOL_DIR:
+        sweep_dirs.append(TG_BOT_API_SPOOL_DIR)
+    for sweep_dir in sweep_dirs:
+        try:
+            entries = list(os.scandir(sweep_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            path = entry.path.removesuffix(".cookies.txt")
+            if not is_download_dir_name(entry.name) or path in live_dirs:
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime > orphaned_before:
+                    continue
+            except FileNotFoundError:
+                continue
+            logger.info("Removing orphaned download dir: %s", entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+            ORPHANED_DIRS_REMOVED.inc()
+    used = 0
+    for root, dirs, files in os.walk(DL_DIR):
+        for file in files:
+            try:
+                used += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    os.makedirs(DL_DIR, exist_ok=True)
+    free = shutil.disk_usage(DL_DIR).free
+    DL_DIR_BYTES.labels(kind="used").set(used)
+    DL_DIR_BYTES.labels(kind="free").set(free)
+    return used, free
+
+
+async def download_done(bot, persistence, kwargs, kind, future):
+    url = kwargs["url"]
+    download_key = f"{kind} {url}"
+    subscribers = DOWNLOADS_IN_PROGRESS.pop(download_key, [])
+    result = None
+    timed_out = False
+    outcome = "error"
+    try:
+        result = future.result()
+        outcome = result["status"]
+    except TimeoutError:
+        logger.debug("download_url_and_send took too much time and was dropped: %s", url)
+        timed_out = True
+        outcome = "timeout"
+    except (MemoryError, ProcessExpired) as exc:
+        # Worker hit its address space limit or was killed by OOM killer:
+        if isinstance(exc, MemoryError) or exc.exitcode == -signal.SIGKILL:
+            logger.debug("download_url_and_send ran out of memory: %s", url)
+            outcome = "memory"
+        else:
+            logger.debug("download_url_and_send worker died: %s", url)
+    except Exception:
+        logger.debug("download_url_and_send failed for some unhandled reason: %s", url)
+    site = get_site_label(url)
+    DOWNLOAD_JOBS.labels(site=site, outcome=outcome).inc()
+    if result:
+        observe_worker_metrics(site, result["metrics"])
+    record_egress_health(kwargs, site, outcome, result)
+    if outcome == "egress_failed":
+        # Worker didn't tell user about failure, so leader tries once more on another proxy and source IP:
+        logger.debug("Retrying on another egress after %s error: %s", result["egress_error"], url)
+        EGRESS_RETRIES.labels(site=site, error=result["egress_error"]).inc()
+        retry_kwargs = dict(kwargs, egress_retry=False)
+        retry_kwargs["proxy"] = PROXY_SELECTOR.pick(site, exclude=[kwargs["proxy"]]) if PROXIES else kwargs["proxy"]
+        retry_kwargs["source_ip"] = SOURCE_IP_SELECTOR.pick(site, exclude=[kwargs["source_ip"]]) if SOURCE_IPS else kwargs["source_ip"]
+        schedule_download(bot, persistence, retry_kwargs, kind, priority=True)
+        DOWNLOADS_IN_PROGRESS[download_key].extend(subscribers)
+        return
+    cacheable = result and result["cacheable"]
+    if cacheable:
+        put_cached_file_ids(persistence, url, kind, result["items"])
+    text = DL_TIMEOUT_TEXT if timed_out else TOO_LARGE_TEXT if outcome == "memory" else FAILED_TEXT
+    if result is None:
+        # Worker was killed or died before it could tell leader chat about it:
+        await send_failure_text(bot, kwargs, text)
+    if not subscribers:
+        return
+    logger.debug("Sending download result to %s subscribers: %s", len(subscribers), url)
+    if cacheable:
+        for subscriber in subscribers:
+            try:
+                await send_cached_file_ids(bot, subscriber["chat_id"], result["items"], flood=subscriber["flood"], reply_to_message_id=subscriber["reply_to_message_id"])
+            except TelegramError:
+                logger.debug("Sending to subscriber failed: %s", subscriber["chat_id"])
+            await delete_wait_message(bot, subscriber)
+    elif result is None or result["status"] == "failed":
+        for subscriber in subscribers:
+            await send_failure_text(bot, subscriber, text)
+    else:
+        # Files were downloaded, but not sent to leader chat, so next subscriber becomes leader and tries by itself.
+        # Subscribers have already waited, so they get priority:
+        leader_kwargs = subscribers.pop(0)
+        schedule_download(bot, persistence, leader_kwargs, kind, priority=True)
+        DOWNLOADS_IN_PROGRESS[download_key].extend(subscribers)
+
+
+def record_egress_health(kwargs, site, outcome, result):
+    seconds = None
+    error = None
+    if result:
+        seconds = sum(stage_seconds for stage, stage_outcome, stage_seconds in result["metrics"]["stages"] if stage == "download")
+        error = result.get("egress_error")
+    if outcome == "success":
+        ok = True
+    elif error or outcome == "timeout":
+        # Dead proxy usually hangs until timeout:
+        ok = False
+    else:
+        # Other failures (e.g. private track) say nothing about egress:
+        return
+    PROXY_SELECTOR.record(kwargs.get("proxy"), site, ok, seconds, error)
+    SOURCE_IP_SELECTOR.record(kwargs.get("source_ip"), site, ok, seconds, error)
+
+
+def get_site_label(url):
+    return classify_url(URL(url)).site or "unknown"
+
+
+def observe_worker_metrics(site, metrics):
+    for stage, outcome, seconds in metrics["stages"]:
+        STAGE_DURATION.labels(stage=stage, site=site, outcome=outcome).observe(seconds)
+    TRANSFERRED_BYTES.labels(direction="download", site=site).inc(metrics["downloaded_bytes"])
+    TRANSFERRED_BYTES.labels(direction="upload", site=site).inc(metrics["uploaded_bytes"])
+    WORKER_PEAK_RSS.labels(site=site).observe(metrics["peak_rss"])
+    for upload_speed in metrics["upload_speeds"]:
+        UPLOAD_SPEED.labels(site=site).observe(upload_speed)
+    for error, action in metrics["telegram_errors"]:
+        WORKER_TELEGRAM_ERRORS.labels(error=error, action=action).inc()
+
+
+def count_worker_recycle(future):
+    # Runs in pebble thread, worker has recycled itself after sending result (see install_worker_recycling):
+    try:
+        result = future.result()
+    except Exception:
+        return
+    if result["worker"]["recycle"]:
+        logger.debug("Worker %s recycled with RSS %s", result["worker"]["pid"], result["worker"]["rss"])
+        WORKER_RECYCLES.inc()
+
+
+async def send_failure_text(bot, kwargs, text):
+    try:
+        await bot.send_message(chat_id=kwargs["chat_id"], reply_to_message_id=kwargs["reply_to_message_id"], text=text, parse_mode="Markdown")
+    except TelegramError:
+        logger.debug("Sending failure text failed: %s", kwargs["chat_id"])
+    await delete_wait_message(bot, kwargs)
+
+
+async def delete_wait_message(bot, kwargs):
+    if kwargs["wait_message_id"]:
+        try:
+            await bot.delete_message(chat_id=kwargs["chat_id"], message_id=kwargs["wait_message_id"])
+        except TelegramError:
+            pass
+
+
 async def dl_link_commands_and_messages_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = None
     if update.channel_post:
@@ -435,12 +1673,9 @@ async def dl_link_commands_and_messages_callback(update: Update, context: Contex
     if chat_type == Chat.PRIVATE or command_passed:
         apologize = True
     reply_to_message_id = message.message_id
-    source_ip = None
-    if SOURCE_IPS:
-        source_ip = random.choice(SOURCE_IPS)
-    proxy = None
-    if PROXIES:
-        proxy = random.choice(PROXIES)
+    # Egress for checking links, downloads get their own egress for their sites when started:
+    source_ip = SOURCE_IP_SELECTOR.pick(trial=False)
+    proxy = PROXY_SELECTOR.pick(trial=False)
     wait_message_id = None
     if action in ["dl", "link"]:
         await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
@@ -448,34 +1683,16 @@ async def dl_link_commands_and_messages_callback(update: Update, context: Contex
         wait_message_id = wait_message.message_id
 
     urls_dict = {}
-
-    # Get our main running asyncio loop:
-    loop_main = asyncio.get_running_loop()
-
-    # a) Run heavy task blocking the main running asyncio loop.
-    # Needs to have timeout signals in function, but they are bad.
-    # urls_dict = get_direct_urls_dict(message, action, proxy, source_ip, allow_unknown_sites)
-
-    # b) Run heavy task in separate process or thread, but without blocking the main running asyncio loop.
-    # Function will continue working till the end: https://stackoverflow.com/a/34457515/2490759
-    # You may add timeout signals in function, but they are bad.
-    # If ThreadPoolExecutor - no signals.
-    # We monitor EXECUTOR process pool task queue, so we use it.
-
-    # pool = concurrent.futures.ThreadPoolExecutor()
+    # URLs preparation is mostly entities parsing and a few short links resolving requests,
+    # so we run it right in the main asyncio loop instead of occupying download workers with pickled message:
     try:
-        # https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.run_in_executor
         # https://docs.python.org/3/library/asyncio-task.html#asyncio.wait_for
-        # urls_dict = await asyncio.wait_for(
-        #     loop_main.run_in_executor(EXECUTOR, get_direct_urls_dict, message, action, proxy, source_ip, allow_unknown_sites),
-        #     timeout=CHECK_URL_TIMEOUT * 10,
-        # )
-        urls_dict = await loop_main.run_in_executor(EXECUTOR, get_direct_urls_dict, CHECK_URL_TIMEOUT, message, action, proxy, source_ip, allow_unknown_sites)
+        urls_dict = await asyncio.wait_for(get_direct_urls_dict(message, action, proxy, source_ip, allow_unknown_sites), timeout=CHECK_URL_TIMEOUT)
     except asyncio.TimeoutError:
-        logger.debug("get_direct_urls_dict took too much time and was dropped (but still running)")
+        logger.debug("get_direct_urls_dict took too much time and was dropped")
     except Exception:
         logger.debug("get_direct_urls_dict failed for some unhandled reason")
-    # pool.shutdown(wait=False, cancel_futures=True)
+        logger.debug(traceback.format_exc())
 
     logger.debug(f"prepare_urls: urls dict: {urls_dict}")
     urls_values = " ".join(urls_dict.values())
@@ -488,6 +1705,7 @@ async def dl_link_commands_and_messages_callback(update: Update, context: Contex
             await context.bot.delete_message(chat_id=chat_id, message_id=wait_message_id)
         else:
             await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            scheduled = False
             for url in urls_dict:
                 direct_urls_status = urls_dict[url]
                 if direct_urls_status in ["failed", "restrict_direct", "restrict_region", "restrict_live", "timeout"]:
@@ -514,14 +1732,15 @@ async def dl_link_commands_and_messages_callback(update: Update, context: Contex
                         "flood": context.chat_data["settings"]["flood"],
                         "reply_to_message_id": reply_to_message_id,
                         "wait_message_id": wait_message_id,
-                        "cookies_file": COOKIES_FILE,
+                        "cookies_file": get_cookies_file(),
                         "source_ip": source_ip,
                         "proxy": proxy,
                     }
-                    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.RECORD_VOICE)
-                    # Run heavy task in separate process, "fire and forget":
-                    # EXECUTOR.submit(download_url_and_send, **kwargs)
-                    EXECUTOR.schedule(download_url_and_send, kwargs=kwargs, timeout=DL_TIMEOUT)
+                    # Private chats and explicit commands go before passive group messages:
+                    if await dl_url(context, kwargs, priority=(chat_type == Chat.PRIVATE or command_passed)):
+                        scheduled = True
+            if not scheduled:
+                await context.bot.delete_message(chat_id=chat_id, message_id=wait_message_id)
 
     elif action == "link":
         if "http" not in urls_values:
@@ -539,13 +1758,40 @@ async def dl_link_commands_and_messages_callback(update: Update, context: Contex
                 await context.bot.send_message(chat_id=chat_id, reply_to_message_id=reply_to_message_id, text=NO_URLS_TEXT, parse_mode="Markdown")
         else:
             url_message_id = str(reply_to_message_id)
-            context.chat_data[url_message_id] = {"urls": urls_dict, "source_ip": source_ip, "proxy": proxy}
             question = "🎶 links found, what to do?"
             button_dl = InlineKeyboardButton(text="⬇️ Download", callback_data=" ".join([url_message_id, "dl"]))
             button_link = InlineKeyboardButton(text="🔗️ Get links", callback_data=" ".join([url_message_id, "link"]))
             button_cancel = InlineKeyboardButton(text="❌", callback_data=" ".join([url_message_id, "cancel"]))
             inline_keyboard = InlineKeyboardMarkup([[button_dl, button_link, button_cancel]])
-            await context.bot.send_message(chat_id=chat_id, reply_to_message_id=reply_to_message_id, reply_markup=inline_keyboard, text=question)
+            question_message = await context.bot.send_message(chat_id=chat_id, reply_to_message_id=reply_to_message_id, reply_markup=inline_keyboard, text=question)
+            context.chat_data[url_message_id] = {
+                "urls": urls_dict,
+                "source_ip": source_ip,
+                "proxy": proxy,
+                "time": time.time(),
+                "question_message_id": question_message.message_id,
+            }
+            # Oldest questions over the limit are forgotten right away:
+            stale_asks = get_ask_entries(context.chat_data)[:-MAX_CHAT_ASKS]
+            await forget_asks(context.bot, chat_id, context.chat_data, stale_asks)
+
+
+def get_ask_entries(chat_data):
+    """Return pending "ask" mode questions of chat as (url_message_id, entry) list, oldest first."""
+    asks = [(key, entry) for key, entry in chat_data.items() if key != "settings" and isinstance(entry, dict) and "urls" in entry]
+    # Entries saved before they had time are the oldest:
+    return sorted(asks, key=lambda ask: ask[1].get("time", 0))
+
+
+async def forget_asks(bot, chat_id, chat_data, asks):
+    for url_message_id, entry in asks:
+        chat_data.pop(url_message_id, None)
+    question_message_ids = [entry["question_message_id"] for url_message_id, entry in asks if entry.get("question_message_id")]
+    if ASK_DELETE_STALE and question_message_ids:
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=question_message_ids)
+        except TelegramError:
+            logger.debug("Deleting stale questions failed: %s", chat_id)
 
 
 async def button_press_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -605,6 +1851,7 @@ async def button_press_callback(update: Update, context: ContextTypes.DEFAULT_TY
         if button_action == "dl":
             await update.callback_query.answer(text=get_random_wait_text())
             wait_message = await update.callback_query.edit_message_text(parse_mode="Markdown", text=f"_{get_random_wait_text()}_")
+            scheduled = False
             for url in urls_dict:
                 kwargs = {
                     "bot_options": {
@@ -618,14 +1865,14 @@ async def button_press_callback(update: Update, context: ContextTypes.DEFAULT_TY
                     "flood": context.chat_data["settings"]["flood"],
                     "reply_to_message_id": url_message_id,
                     "wait_message_id": wait_message.message_id,
-                    "cookies_file": COOKIES_FILE,
+                    "cookies_file": get_cookies_file(),
                     "source_ip": url_message_data["source_ip"],
                     "proxy": url_message_data["proxy"],
                 }
-                await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.RECORD_VOICE)
-                # Run heavy task in separate process, "fire and forget":
-                # EXECUTOR.submit(download_url_and_send, **kwargs)
-                EXECUTOR.schedule(download_url_and_send, kwargs=kwargs, timeout=DL_TIMEOUT)
+                if await dl_url(context, kwargs, priority=(chat_type == Chat.PRIVATE)):
+                    scheduled = True
+            if not scheduled:
+                await context.bot.delete_message(chat_id=chat_id, message_id=wait_message.message_id)
 
         elif button_action == "link":
             await context.bot.send_message(chat_id=chat_id, reply_to_message_id=url_message_id, parse_mode="Markdown", disable_web_page_preview=True, text=get_link_text(urls_dict))
@@ -692,7 +1939,37 @@ def init_chat_data(chat_data, mode="dl", flood=True):
         chat_data["settings"]["allow_unknown_sites"] = False
 
 
-def get_direct_urls_dict(message, mode, proxy, source_ip, allow_unknown_sites):
+def get_http_client(proxy=None):
+    # Shared async HTTP clients (with their connection pools) for main process, one per proxy:
+    if proxy not in HTTP_CLIENTS:
+        HTTP_CLIENTS[proxy] = httpx.AsyncClient(proxy=proxy, follow_redirects=True, timeout=COMMON_CONNECTION_TIMEOUT)
+    return HTTP_CLIENTS[proxy]
+
+
+async def unshorten_url(url, proxy=None):
+    # Unshorten soundcloud.app.goo.gl and on.soundcloud.com links. Example: https://soundcloud.app.goo.gl/mBMvG
+    # FIXME spotdl to transform spotify link to youtube music link?
+    # TODO Unshorten unknown sites links again? Because yt-dlp may only support unshortened?
+    if classify_url(url).kind != "short":
+        return url
+    url_text = url.to_text(full_quote=True)
+    # LRU cache of resolved short links: plain dict in insertion order, most recently used entries at the end.
+    unshortened_url_text = UNSHORTENED_URLS.pop(url_text, None)
+    if unshortened_url_text is None:
+        try:
+            r = await get_http_client(proxy).head(url_text, timeout=2, headers={"User-Agent": get_user_agent()})
+            unshortened_url_text = str(r.url)
+        except (httpx.HTTPError, ImportError, ValueError):
+            # ImportError is for SOCKS proxies without socksio installed:
+            logger.debug("Could not unshorten link: %s", url_text)
+            return url
+    UNSHORTENED_URLS[url_text] = unshortened_url_text
+    while len(UNSHORTENED_URLS) > UNSHORTENED_URLS_CACHE_SIZE:
+        UNSHORTENED_URLS.pop(next(iter(UNSHORTENED_URLS)))
+    return URL(unshortened_url_text)
+
+
+async def get_direct_urls_dict(message, mode, proxy, source_ip, allow_unknown_sites):
     # If telegram message passed:
     urls = []
     url_entities = message.parse_entities(types=[MessageEntity.URL])
@@ -727,82 +2004,70 @@ def get_direct_urls_dict(message, mode, proxy, source_ip, allow_unknown_sites):
     logger.info(f"prepare_urls: urls list: {urls}")
 
     urls_dict = {}
-    for url_item in urls:
-        unknown_site = not any((re.match(domain, url_item.host) for domain in DOMAINS))
-        # Unshorten soundcloud.app.goo.gl and unknown sites links. Example: https://soundcloud.app.goo.gl/mBMvG
-        # FIXME spotdl to transform spotify link to youtube music link?
-        # TODO Unshorten unknown sites links again? Because yt-dlp may only support unshortened?
-        # if unknown_site or DOMAIN_SC_GOOGL in url_item.host:
-        if DOMAIN_SC_GOOGL in url_item.host or DOMAIN_SC_ON in url_item.host:
-            proxy_args = None
-            if proxy:
-                proxy_args = {"http": proxy, "https": proxy}
-            try:
-                url = URL(
-                    requests.head(
-                        url_item.to_text(full_quote=True),
-                        allow_redirects=True,
-                        timeout=2,
-                        proxies=proxy_args,
-                        headers={"User-Agent": UA.random},
-                        # headers={"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"},
-                    ).url
-                )
-            except:
-                url = url_item
-        else:
-            url = url_item
-        unknown_site = not any((re.match(domain, url.host) for domain in DOMAINS))
+    # Resolve short links concurrently:
+    unshortened_urls = await asyncio.gather(*[unshorten_url(url_item, proxy) for url_item in urls])
+    for url in unshortened_urls:
+        site_info = classify_url(url)
         url_text = url.to_text(full_quote=True)
         logger.debug(f"Unshortened link: {url_text}")
         # url_text = url_text.replace("m.soundcloud.com", "soundcloud.com")
-        url_parts_num = len([part for part in url.path_parts if part])
-        if unknown_site or mode == "link":
+        if not site_info.site or mode == "link":
             # We run it if it was explicitly requested as per "link" mode.
             # We run it for links from unknown sites (if they were allowed).
             # FIXME For now we avoid extra requests on asking just to improve responsiveness. We are okay with useless asking (for unknown sites). Link mode might be removed.
-            # If it's a known site, we check it more thoroughly below.
-            # urls_dict[url_text] = ydl_get_direct_urls(url_text, COOKIES_FILE, source_ip, proxy)
-            urls_dict[url_text] = "http"
-        elif ((DOMAIN_SC in url.host) and (2 <= url_parts_num <= 4) and (not "you" in url.path_parts) and (not "likes" in url.path_parts)) or (DOMAIN_SC_GOOGL in url.host) or (DOMAIN_SC_API in url.host):
-            # SoundCloud: tracks, sets and widget pages, no /you/ pages
-            # TODO support private sets URLs that have 5 parts
-            # We know for sure these links can be downloaded, so we just skip running ydl_get_direct_urls
-            urls_dict[url_text] = "http"
-        elif DOMAIN_BC in url.host and (2 <= url_parts_num <= 2):
-            # Bandcamp: tracks and albums
-            # We know for sure these links can be downloaded, so we just skip running ydl_get_direct_urls
-            urls_dict[url_text] = "http"
-        elif ((DOMAIN_YT in url.host) and ("watch" in url.path or "playlist" in url.path)) or (DOMAIN_YT_BE in url.host):
-            # YouTube: videos and playlists
-            # We still run it for checking YouTube region restriction to avoid useless asking.
-            # FIXME For now we avoid extra requests on asking just to improve responsiveness. We are okay with useless asking (for youtube).
-            # urls_dict[url_text] = ydl_get_direct_urls(url_text, COOKIES_FILE, source_ip, proxy)
+            # If it's a known site, we check its link kind below.
+            # urls_dict[url_text] = ydl_get_direct_urls(url_text, get_cookies_file(), source_ip, proxy)
             urls_dict[url_text] = "http"
-        elif DOMAIN_YMR in url.host or DOMAIN_YMC in url.host:
-            # YM: tracks. Note that the domain includes x.com..
-            # We know for sure these links can be downloaded, so we just skip running ydl_get_direct_urls
-            urls_dict[url_text] = "http"
-        elif DOMAIN_TT in url.host:
-            # TikTok: videos
-            # We know for sure these links can be downloaded, so we just skip running ydl_get_direct_urls
-            urls_dict[url_text] = "http"
-        elif DOMAIN_IG in url.host and (2 <= url_parts_num):
-            # Instagram: videos, reels
-            # We run it for checking Instagram ban to avoid useless asking.
-            # FIXME For now we avoid extra requests on asking just to improve responsiveness. We are okay with useless asking (for instagram).
-            # urls_dict[url_text] = ydl_get_direct_urls(url_text, COOKIES_FILE, source_ip, proxy)
-            urls_dict[url_text] = "http"
-        elif (DOMAIN_TW in url.host or DOMAIN_TWX in url.host) and (DOMAIN_YMC not in url.host) and (3 <= url_parts_num <= 3):
-            # Twitter: videos
-            # We know for sure these links can be downloaded, so we just skip running ydl_get_direct_urls
+        elif site_info.kind:
+            # We know for sure these links can be downloaded, so we just skip running ydl_get_direct_urls.
+            # FIXME For now we avoid extra requests on asking just to improve responsiveness, even for YouTube region restriction and Instagram ban.
+            # urls_dict[url_text] = ydl_get_direct_urls(url_text, get_cookies_file(), source_ip, proxy)
             urls_dict[url_text] = "http"
     return urls_dict
 
 
+def set_ydl_cookies_opts(ydl_opts, cookies_file, cookies_copy_path):
+    # Cookies are fetched and materialized by main process (see callback_cookies_refresh), so we only use local files here.
+    # yt-dlp may save cookies back to cookiefile, so we give it own copy and keep shared file untouched:
+    if not cookies_file:
+        return
+    if cookies_file.startswith("firefox:"):
+        ydl_opts["cookiesfrombrowser"] = ("firefox", cookies_file.split(":", maxsplit=2)[1], None, None)
+    else:
+        try:
+            shutil.copyfile(cookies_file, cookies_copy_path)
+            ydl_opts["cookiefile"] = cookies_copy_path
+        except OSError:
+            logger.debug("Could not copy cookies file: %s", cookies_file)
+
+
+def import_ydl():
+    # Heavy modules are imported on first use, worker processes get them preloaded by forkserver.
+    # Support different old versions just in case:
+    # https://github.com/yt-dlp/yt-dlp/wiki/Forks
+    try:
+        import yt_dlp as ydl
+    except ImportError:
+        try:
+            import youtube_dl as ydl
+        except ImportError:
+            import youtube_dlc as ydl
+    return ydl
+
+
+def get_user_agent():
+    global UA
+    if UA is None:
+        from fake_useragent import UserAgent
+
+        UA = UserAgent(browsers=["Google", "Chrome", "Firefox", "Edge"], platforms=["desktop"], os=["Windows", "Linux", "Ubuntu"])
+    return UA.random
+
+
 def ydl_get_direct_urls(url, cookies_file=None, source_ip=None, proxy=None):
     # TODO transform into unified ydl function and deduplicate
     logger.debug("Entering: ydl_get_direct_urls: %s", url)
+    ydl = import_ydl()
     status = ""
     cmd_name = "ydl_get_direct_urls"
     ydl_opts = {
@@ -815,43 +2080,9 @@ def ydl_get_direct_urls(url, cookies_file=None, source_ip=None, proxy=None):
         ydl_opts["proxy"] = proxy
     if source_ip:
         ydl_opts["source_address"] = source_ip
-    cookies_download_file = None
-    if cookies_file:
-        cookies_download_file = tempfile.NamedTemporaryFile(mode="wb", delete=False)
-        cookies_download_file_path = pathlib.Path(cookies_download_file.name)
-        if cookies_file.startswith("http"):
-            # URL for downloading cookie file:
-            try:
-                r = requests.get(cookies_file, allow_redirects=True, timeout=5)
-                cookies_download_file.write(r.content)
-                cookies_download_file.close()
-                ydl_opts["cookiefile"] = str(cookies_download_file_path)
-            except:
-                logger.debug("download_url_and_send could not download cookies file")
-                pass
-        elif cookies_file.startswith("firefox:"):
-            # TODO handle env var better
-            cookies_file_components = cookies_file.split(":", maxsplit=2)
-            if len(cookies_file_components) == 3:
-                cookies_sqlite_file = cookies_file_components[2]
-                cookies_download_sqlite_path = pathlib.Path.home() / ".mozilla" / "firefox" / cookies_file_components[1] / "cookies.sqlite"
-                # URL for downloading cookie sqlite file:
-                try:
-                    r = requests.get(cookies_sqlite_file, allow_redirects=True, timeout=5)
-                    with open(cookies_download_sqlite_path, "wb") as cfile:
-                        cfile.write(r.content)
-                    ydl_opts["cookiesfrombrowser"] = ("firefox", cookies_file_components[1], None, None)
-                    logger.debug("download_url_and_send downloaded cookies.sqlite file")
-                except:
-                    logger.debug("download_url_and_send could not download cookies.sqlite file")
-                    pass
-            else:
-                ydl_opts["cookiesfrombrowser"] = ("firefox", cookies_file_components[1], None, None)
-        else:
-            # cookie file local path:
-            cookies_download_file.write(open(cookies_file, "rb").read())
-            cookies_download_file.close()
-            ydl_opts["cookiefile"] = str(cookies_download_file_path)
+    cookies_fd, cookies_copy_path = tempfile.mkstemp(suffix=".txt")
+    os.close(cookies_fd)
+    set_ydl_cookies_opts(ydl_opts, cookies_file, cookies_copy_path)
 
     logger.debug("%s starts: %s", cmd_name, url)
     try:
@@ -879,13 +2110,220 @@ def ydl_get_direct_urls(url, cookies_file=None, source_ip=None, proxy=None):
         logger.debug("%s failed: %s", cmd_name, url)
         logger.debug(traceback.format_exc())
         status = "failed"
-    if cookies_file:
-        cookies_download_file.close()
-        os.unlink(cookies_download_file.name)
+    os.unlink(cookies_copy_path)
 
     return status
 
 
+def is_partial_file(file):
+    # Not only "track.mp3.part", but also "track.temp.mp3" of ffmpeg postprocessors:
+    return any(suffix.lower() in PARTIAL_FILE_EXTS for suffix in pathlib.PurePath(file).suffixes)
+
+
+def get_egress_error(error_text, site=None):
+    """Return "region" or "network" if download error looks like problem of proxy or source IP, else None."""
+    error_text = error_text.lower()
+    if any(marker in error_text for marker in EGRESS_REGION_ERRORS):
+        return "region"
+    if site in EGRESS_BLOCKING_SITES and any(marker in error_text for marker in EGRESS_BLOCK_ERRORS):
+        # Site blocked this egress, it still may work for other sites:
+        return "region"
+    if any(marker in error_text for marker in EGRESS_NETWORK_ERRORS):
+        return "network"
+    return None
+
+
+def get_telegram_retry_delay(exc, attempt):
+    """Return seconds to wait before next attempt of Telegram request failed with exc, or None if it must not be retried."""
+    if isinstance(exc, RetryAfter):
+        retry_after = exc.retry_after
+        if isinstance(retry_after, datetime.timedelta):
+            retry_after = retry_after.total_seconds()
+        # Jitter, so that workers flooded at once don't come back at once:
+        return retry_after + random.uniform(0, 1)
+    if isinstance(exc, (BadRequest, Forbidden, ChatMigrated, InvalidToken)):
+        # BadRequest is NetworkError subclass, but it won't succeed on retry:
+        return None
+    if isinstance(exc, NetworkError):
+        # TimedOut is NetworkError too. Full jitter backoff:
+        return random.uniform(0, min(TG_SEND_BACKOFF_MAX, TG_SEND_BACKOFF_BASE * 2 ** (attempt - 1)))
+    return None
+
+
+def add_stage_metric(metrics, stage, outcome, started):
+    metrics["stages"].append((stage, outcome, time.monotonic() - started))
+
+
+def get_ydl_description(info_dict):
+    if not info_dict.get("description"):
+        return ""
+    # TODO handle right-to-left hashtags better (like https://www.instagram.com/reel/CtZbNhtrJv3/)
+    # TODO format as bold/link/quote
+    unescaped_add_description = "\n"
+    if info_dict.get("channel"):
+        unescaped_add_description += "@ " + info_dict["channel"]
+    if info_dict.get("uploader"):
+        unescaped_add_description += " " + info_dict["uploader"]
+    unescaped_add_description += "\n" + info_dict["description"][:800]
+    return escape_markdown(unescaped_add_description, version=1)
+
+
+class MediaInspector:
+    """Media files properties of one download job, every file is inspected at most once.
+
+    MP3 files are read in process by mutagen, other files are probed by one ffprobe run,
+    and videos downloaded by yt-dlp are described by its info dict without probing at all.
+    Properties are: size, duration, width and height of video, codecs, performer and title, ID3 tags of MP3.
+    """
+
+    def __init__(self):
+        # (path, size, mtime) -> properties, so file changed after inspection (e.g. tagged) is inspected again:
+        self.media = {}
+
+    @staticmethod
+    def get_key(file):
+        stat = os.stat(file)
+        return file, stat.st_size, stat.st_mtime_ns
+
+    def inspect(self, file):
+        key = self.get_key(file)
+        if key not in self.media:
+            logger.debug("Inspecting: %s", file)
+            self.media[key] = self.read(file, key[1])
+        return self.media[key]
+
+    def add_ydl_info(self, info):
+        # yt-dlp knows duration and dimensions of downloaded video already:
+        if not (info.get("duration") and info.get("width") and info.get("height")):
+            return
+        self.media[self.get_key(info["filepath"])] = {
+            "size": os.path.getsize(info["filepath"]),
+            "duration": float(info["duration"]),
+            "width": int(info["width"]),
+            "height": int(info["height"]),
+            "codecs": [codec for codec in [info.get("vcodec"), info.get("acodec")] if codec and codec != "none"],
+            "performer": None,
+            "title": None,
+            "id3": None,
+        }
+
+    @staticmethod
+    def read(file, size):
+        media = {"size": size, "duration": None, "width": None, "height": None, "codecs": [], "performer": None, "title": None, "id3": None}
+        if file.lower().endswith(".mp3"):
+            from mutagen.mp3 import MP3
+
+            mp3 = MP3(file)
+            media["duration"] = mp3.info.length
+            media["codecs"] = ["mp3"]
+            if mp3.tags is not None:
+                media["id3"] = mp3.tags
+                if "TPE1" in mp3.tags:
+                    media["performer"] = ", ".join(mp3.tags["TPE1"].text)
+                if "TIT2" in mp3.tags:
+                    media["title"] = ", ".join(mp3.tags["TIT2"].text)
+            return media
+        import ffmpeg
+
+        probe = ffmpeg.probe(file)
+        if "duration" in probe["format"]:
+            media["duration"] = float(probe["format"]["duration"])
+        for stream in probe["streams"]:
+            media["codecs"].append(stream.get("codec_name"))
+            if stream["codec_type"] == "video" and media["width"] is None:
+                media["width"] = int(stream["width"])
+                media["height"] = int(stream["height"])
+        return media
+
+
+def get_ydl_finished_file_pp(queue_finished_file, download_video, media_inspector):
+    """Return yt-dlp postprocessor which reports every downloaded item (e.g. of playlist) as soon as it's finished."""
+    ydl = import_ydl()
+
+    class FinishedFilePP(ydl.postprocessor.PostProcessor):
+        def run(self, info):
+            if download_video:
+                media_inspector.add_ydl_info(info)
+            queue_finished_file(info["filepath"], get_ydl_description(info) if download_video else "")
+            return [], info
+
+    return FinishedFilePP()
+
+
+def get_fit_bitrate(duration):
+    """Return highest MP3 bitrate (in kbit/s) below 320 keeping audio of this duration (in seconds) in one MAX_TG_FILE_SIZE file, or None."""
+    if not FIT_TO_LIMIT or not duration:
+        return None
+    # Constant bitrate gives predictable size, and the same share of limit is left for tags and artwork as for split parts:
+    max_bitrate = MAX_TG_FILE_SIZE * SPLIT_PART_SIZE_RATIO * 8 / 1000 / duration
+    if max_bitrate >= MP3_BITRATES[0]:
+        return None
+    for bitrate in MP3_BITRATES:
+        if FIT_MIN_BITRATE <= bitrate <= max_bitrate:
+            return bitrate
+    # Too long even for minimal bitrate, so it's encoded as usual and split:
+    return None
+
+
+def get_ydl_fit_bitrate_pp():
+    """Return yt-dlp pre_process postprocessor which sets ExtractAudio bitrate by duration of every item (see get_fit_bitrate)."""
+    ydl = import_ydl()
+
+    class FitBitratePP(ydl.postprocessor.PostProcessor):
+        def run(self, info):
+            bitrate = get_fit_bitrate(info.get("duration"))
+            # ExtractAudio reads its ffmpeg output args (by lowercase key) from params when it runs, and last "-b:a" overrides its own one:
+            postprocessor_args = self._downloader.params["postprocessor_args"]
+            args = list(postprocessor_args.get("extractaudio", []))
+            # Bitrate of previous playlist item is replaced:
+            if "-b:a" in args:
+                del args[args.index("-b:a") : args.index("-b:a") + 2]
+            if bitrate:
+                args += ["-b:a", f"{bitrate}k"]
+            postprocessor_args["extractaudio"] = args
+            if bitrate:
+                self.write_debug(f"Fit to limit: {bitrate}k for {info.get('duration')} s")
+            return [], info
+
+    return FitBitratePP()
+
+
+def place_for_local_bot_api(file_path):
+    """Return path of file for local Bot API server: file itself or its hardlink/reflink/copy in spool directory."""
+    if not TG_BOT_API_SPOOL_DIR:
+        return file_path
+    # Bot API server takes file name from path, so every file gets its own spool subdirectory:
+    spool_path = os.path.join(TG_BOT_API_SPOOL_DIR, str(uuid4()), os.path.basename(file_path))
+    os.makedirs(os.path.dirname(spool_path))
+    try:
+        os.link(file_path, spool_path)
+        return spool_path
+    except OSError:
+        logger.debug("Hardlink to spool failed, trying reflink: %s", file_path)
+    try:
+        if fcntl is None:
+            raise OSError
+        with open(file_path, "rb") as src, open(spool_path, "wb") as dst:
+            # Copy-on-write clone, e.g. on Btrfs/XFS across subvolumes:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        logger.debug("Reflink to spool failed, copying: %s", file_path)
+        shutil.copyfile(file_path, spool_path)
+    return spool_path
+
+
+def get_local_bot_api_uri(local_path):
+    if TG_BOT_API_SPOOL_DIR and TG_BOT_API_SPOOL_URI_DIR != TG_BOT_API_SPOOL_DIR:
+        local_path = os.path.join(TG_BOT_API_SPOOL_URI_DIR, os.path.relpath(local_path, TG_BOT_API_SPOOL_DIR))
+    return pathlib.Path(local_path).absolute().as_uri()
+
+
+def remove_from_spool(local_path):
+    # Called only after Bot API server has answered, so it has already read the file:
+    if TG_BOT_API_SPOOL_DIR:
+        shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+
+
 def download_url_and_send(
     bot_options,
     chat_id,
@@ -896,505 +2334,600 @@ def download_url_and_send(
     cookies_file=None,
     source_ip=None,
     proxy=None,
+    download_dir=None,
+    egress_retry=False,
 ):
+    global WORKER_RECYCLE
     logger.debug("Entering: download_url_and_send")
-    # loop_main = asyncio.get_event_loop()
+    import ffmpeg
+    from mutagen.id3 import ID3v1SaveOptions
 
-    # We use ProcessPoolExecutor that runs "fork".
-    # It has really useful fire-and-forget ProcessPoolExecutor.submit() that only accepts sync functions.
-    # Also, there is no point in using asyncio event loop/async functions inside it.
-    # Hence, download_url_and_send() is sync function, not async.
-    # But we still want to use async Bot functions from ptb framework here.
-    # We can't use loop_main.run_in_executor(None) because it doesn't return the result.
-    # We can't use loop_main.run_until_complete() because loop is already running in our forked process.
-    # We can't use asyncio.run_coroutine_threadsafe(coro, loop_main) because it doesn't work (interferes with framework?).
-    # So we run additional loop in additional thread and just use it:
-    loop_additional = asyncio.new_event_loop()
-    thread_additional = threading.Thread(target=loop_additional.run_forever, name="Additional Async Runner", daemon=True)
-
-    def run_async(coro):
-        if not thread_additional.is_alive():
-            thread_additional.start()
-        future = asyncio.run_coroutine_threadsafe(coro, loop_additional)
-        return future.result()
-
-    # We must not pass context/bot here, because they need to get serialized/pickled on "fork" (and they cannot be).
-    # https://docs.python-telegram-bot.org/en/v20.1/telegram.bot.html
-    # So we create and use new Bot object:
-    bot = Bot(
-        token=bot_options["token"],
-        base_url=bot_options["base_url"],
-        base_file_url=bot_options["base_file_url"],
-        local_mode=bot_options["local_mode"],
-        request=HTTPXRequest(http_version=HTTP_VERSION),
-        get_updates_request=HTTPXRequest(http_version=HTTP_VERSION),
-    )
-    run_async(bot.initialize())
+    ydl = import_ydl()
+    bot = get_worker_bot(bot_options)
     logger.debug(bot.token)
-    download_dir = os.path.join(DL_DIR, str(uuid4()))
+    reset_peak_rss()
+    if download_dir is None:
+        download_dir = os.path.join(DL_DIR, str(uuid4()))
     shutil.rmtree(download_dir, ignore_errors=True)
-    os.makedirs(download_dir)
+    # Converted files and split parts are written to separate work dir, so they are not taken for downloaded ones:
+    work_dir = os.path.join(download_dir, WORK_DIR_NAME)
+    os.makedirs(work_dir)
     url_obj = URL(url)
-    host = url_obj.host
+    site_info = classify_url(url_obj)
     download_video = False
     status = "initial"
+    # Download error caused by proxy or source IP ("network" or "region"):
+    egress_error = None
     add_description = ""
-    cmd = None
-    cmd_name = ""
-    cmd_args = ()
-    cmd_input = None
-    if ((DOMAIN_SC in host or DOMAIN_SC_GOOGL in host) and DOMAIN_SC_API not in host) or (DOMAIN_BC in host and BCDL_ENABLE):
-        # If link is sc/bc, we try scdl/bcdl first:
-        if (DOMAIN_SC in host or DOMAIN_SC_GOOGL in host) and DOMAIN_SC_API not in host:
-            cmd = scdl_bin
-            cmd_name = str(cmd)
-            cmd_args = (
-                "-l",
-                url,  # URL of track/playlist/user
-                "-c",  # Continue if a music already exist
-                "--path",
-                download_dir,  # Download the music to a custom path
-                "--onlymp3",  # Download only the mp3 file even if the track is Downloadable
-                "--addtofile",  # Add the artist name to the filename if it isn't in the filename already
-                "--addtimestamp",
-                # Adds the timestamp of the creation of the track to the title (useful to sort chronologically)
-                "--no-playlist-folder",
-                # Download playlist tracks into directory, instead of making a playlist subfolder
-                "--extract-artist",  # Set artist tag from title instead of username
-            )
-            cmd_input = None
-        elif DOMAIN_BC in host and BCDL_ENABLE:
-            cmd = bcdl_bin
-            cmd_name = str(cmd)
-            cmd_args = (
-                "--base-dir",
-                download_dir,  # Base location of which all files are downloaded
-                "--template",
-                "%{track} - %{artist} - %{title} [%{album}]",  # Output filename template
-                "--overwrite",  # Overwrite tracks that already exist
-                "--group",  # Use album/track Label as iTunes grouping
-                "--embed-art",  # Embed album art (if available)
-                "--no-slugify",  # Disable slugification of track, album, and artist names
-                url,  # URL of album/track
-            )
-            cmd_input = "yes"
-
-        env = None
-        if proxy:
-            env = {"http_proxy": proxy, "https_proxy": proxy}
-        logger.debug("%s starts: %s", cmd_name, url)
-        cmd_proc = cmd[cmd_args].popen(env=env, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    # Sent file_ids with captions, they are cached in main process only if everything was sent:
+    sent_items = []
+    cacheable = True
+    # Stages durations (stage, outcome, seconds) and traffic, returned to main process for Prometheus:
+    metrics = {"stages": [], "downloaded_bytes": 0, "uploaded_bytes": 0, "upload_speeds": [], "telegram_errors": []}
+    # Files are inspected once for splitting and sending:
+    media_inspector = MediaInspector()
+
+    def send_file(file, add_description):
+        nonlocal cacheable
+        file_name = os.path.split(file)[-1]
+        file_parts = []
         try:
-            cmd_stdout, cmd_stderr = cmd_proc.communicate(input=cmd_input, timeout=DL_TIMEOUT)
-            cmd_retcode = cmd_proc.returncode
-            # listed are common scdl problems for one track with 0 retcode, all its log output goes to stderr (track may be in stdout):
-            # https://github.com/scdl-org/scdl/issues/493
-            # https://github.com/scdl-org/scdl/pull/494
-            if cmd_retcode or (any(err in cmd_stderr for err in ["Error resolving url", "is not streamable", "Failed to get item"]) and ".mp3" not in cmd_stderr):
-                raise ProcessExecutionError(cmd_args, cmd_retcode, cmd_stdout, cmd_stderr)
-            logger.debug("%s succeeded: %s", cmd_name, url)
-            status = "success"
-        except TimeoutExpired:
-            cmd_proc.kill()
-            logger.debug("%s took too much time and dropped: %s", cmd_name, url)
-        except ProcessExecutionError:
-            logger.debug("%s failed: %s", cmd_name, url)
-            logger.debug(traceback.format_exc())
-
-    if status == "initial":
-        # If link is not sc/bc or scdl/bcdl just failed, we use ydl
-        cmd_name = "ydl_download"
-        # https://github.com/yt-dlp/yt-dlp/blob/master/yt_dlp/YoutubeDL.py#L187
-        # https://github.com/yt-dlp/yt-dlp/blob/master/yt_dlp/utils/_utils.py
-        ydl_opts = {
-            # https://github.com/yt-dlp/yt-dlp#output-template
-            # Default outtmpl is "%(title)s [%(id)s].%(ext)s"
-            # Take first 16 symbols of title:
-            "outtmpl": os.path.join(download_dir, "%(playlist_index|)03d%(playlist_index&_|)s%(title).16s [%(id)s].%(ext)s"),
-            "restrictfilenames": True,
-            "windowsfilenames": True,
-            "max_filesize": MAX_TG_FILE_SIZE * 3,
-            # "js_runtimes": {"node": {}},
-            # TODO Add optional parameter FFMPEG_PATH:
-            # "ffmpeg_location": "/home/gpchelkin/.local/bin/",
-            # "ffmpeg_location": "/usr/local/bin/",
-            # "trim_file_name": 32,
-        }
-        if DOMAIN_TT in host:
-            download_video = True
-            ydl_opts["format"] = "mp4"
-        elif (DOMAIN_TW in host or DOMAIN_TWX in host) and (DOMAIN_YMC not in host):
-            download_video = True
-            ydl_opts["format"] = "mp4"
-        elif DOMAIN_IG in host:
-            download_video = True
-            ydl_opts.update(
-                {
-                    "format": "mp4",
-                    "postprocessors": [
-                        # Instagram usually gives VP9 or HEVC (x265/h265) video codec (when downloading with cookies).
-                        #   VP9 doesn't play in Telegram iOS client;
-                        #   HEVC seems to be used for 4K (2160*3840) videos, and yt-dlp fails converting them (maybe because of MAX_MEM). TODO Check for HEVC and skip converting?
-                        # We need to convert it to AVC (x264/h264) or HEVC (x265/h265) video (+ AAC audio).
-                        # We went with AVC (x264/h264) for now.
-                        # "FFmpegVideoConvertor" doesn't work here since the original file is already in mp4 format.
-                        # We don't touch audio and just copy it here since it's probably OK in original. But we may want to change 'copy' to 'aac' later.
-                        # yt-dlp --use-postprocessor FFmpegCopyStream --ppa copystream:"-codec:v libx264 -crf 24 -preset veryfast -codec:a copy -f mp4 -threads 1" ...
-                        # https://github.com/yt-dlp/yt-dlp/issues/7607
-                        # https://github.com/yt-dlp/yt-dlp/issues/5859
-                        # https://github.com/yt-dlp/yt-dlp/issues/8904
-                        # https://github.com/yt-dlp/yt-dlp/blob/master/devscripts/cli_to_api.py
-                        # {"key": "FFmpegVideoConvertor", "preferedformat": "mp4"},
-                        {"key": "FFmpegCopyStream"},
-                    ],
-                    "postprocessor_args": {
-                        "copystream": ["-codec:v", "libx264", "-crf", "24", "-preset", "veryfast", "-codec:a", "copy", "-f", "mp4", "-threads", "1"],
-                    },
-                }
-            )
-        else:
-            ydl_opts.update(
-                {
-                    "format": "bestaudio/best",
-                    "postprocessors": [
-                        {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "320"},
-                        {"key": "FFmpegMetadata"},
-                        {"key": "EmbedThumbnail", 'already_have_thumbnail': False},
-                    ],
-                    "postprocessor_args": {
-                        "ExtractAudio": ["-threads", "1"],
-                        "extractaudio": ["-threads", "1"],
-                    },
-                    # https://old.reddit.com/r/youtubedl/comments/zh61bw/goal_is_to_download_audio_only_and_embed/
-                    "writethumbnail": True,
-                    "noplaylist": True,
-                }
-            )
-        if proxy:
-            ydl_opts["proxy"] = proxy
-        if source_ip:
-            ydl_opts["source_address"] = source_ip
-        cookies_download_file = None
-        if cookies_file:
-            cookies_download_file = tempfile.NamedTemporaryFile(mode="wb", delete=False)
-            cookies_download_file_path = pathlib.Path(cookies_download_file.name)
-            if cookies_file.startswith("http"):
-                # URL for downloading cookie file:
+            file_root, file_ext = os.path.splitext(file)
+            file_format = file_ext.replace(".", "").lower()
+            file_size = os.path.getsize(file)
+            if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
+                raise FileNotSupportedError(file_format)
+            # We convert if downloaded file is video (except tiktok, instagram, twitter):
+            if file_format in VIDEO_FORMATS and not download_video:
+                if file_size > MAX_CONVERT_FILE_SIZE:
+                    raise FileTooLargeError(file_size)
+                logger.debug("Converting video format: %s", file)
+                stage_started = time.monotonic()
                 try:
-                    r = requests.get(cookies_file, allow_redirects=True, timeout=5)
-                    cookies_download_file.write(r.content)
-                    cookies_download_file.close()
-                    ydl_opts["cookiefile"] = str(cookies_download_file_path)
-                except:
-                    logger.debug("download_url_and_send could not download cookies file")
-                    pass
-            elif cookies_file.startswith("firefox:"):
-                cookies_file_components = cookies_file.split(":", maxsplit=2)
-                if len(cookies_file_components) == 3:
-                    cookies_sqlite_file = cookies_file_components[2]
-                    cookies_download_sqlite_path = pathlib.Path.home() / ".mozilla" / "firefox" / cookies_file_components[1] / "cookies.sqlite"
-                    # URL for downloading cookie sqlite file:
-                    try:
-                        r = requests.get(cookies_sqlite_file, allow_redirects=True, timeout=5)
-                        with open(cookies_download_sqlite_path, "wb") as cfile:
-                            cfile.write(r.content)
-                        ydl_opts["cookiesfrombrowser"] = ("firefox", cookies_file_components[1], None, None)
-                        logger.debug("download_url_and_send downloaded cookies.sqlite file")
-                    except:
-                        logger.debug("download_url_and_send could not download cookies.sqlite file")
-                        pass
-                else:
-                    ydl_opts["cookiesfrombrowser"] = ("firefox", cookies_file_components[1], None, None)
+                    file_converted = os.path.join(work_dir, os.path.basename(file_root) + ".mp3")
+                    ffinput = ffmpeg.input(file)
+                    # https://kkroening.github.io/ffmpeg-python/#ffmpeg.output
+                    # We could set audio_bitrate="320k", but we don't need it now
+                    with TranscodeSlot(metrics):
+                        ffmpeg.output(ffinput, file_converted, vn=None, threads=1).run()
+                    file = file_converted
+                    file_root, file_ext = os.path.splitext(file)
+                    file_format = file_ext.replace(".", "").lower()
+                    file_size = os.path.getsize(file)
+                    add_stage_metric(metrics, "convert", "success", stage_started)
+                except Exception:
+                    add_stage_metric(metrics, "convert", "failed", stage_started)
+                    raise FileNotConvertedError
+
+            file_parts = []
+            if file_size <= MAX_TG_FILE_SIZE:
+                file_parts.append(file)
             else:
-                # cookie file local path:
-                cookies_download_file.write(open(cookies_file, "rb").read())
-                cookies_download_file.close()
-                ydl_opts["cookiefile"] = str(cookies_download_file_path)
-
-        logger.debug("%s starts: %s", cmd_name, url)
-        try:
-            # FIXME Check and proceed even with partial results - e.g. for playlists with only some videos failed (private or more) https://youtube.com/playlist?list=PL2C109776112A2BB3
-            # https://github.com/yt-dlp/yt-dlp/blob/master/README.md#embedding-examples
-            info_dict = ydl.YoutubeDL(ydl_opts).download([url])
-            logger.debug("%s succeeded: %s", cmd_name, url)
-            status = "success"
-            if download_video:
-                unsanitized_info_dict = ydl.YoutubeDL(ydl_opts).extract_info(url, download=False)
-                info_dict = ydl.YoutubeDL(ydl_opts).sanitize_info(unsanitized_info_dict)
-                if "description" in info_dict and info_dict["description"]:
-                    # TODO handle right-to-left hashtags better (like https://www.instagram.com/reel/CtZbNhtrJv3/)
-                    # TODO format as bold/link/quote
-                    unescaped_add_description = "\n"
-                    if "channel" in info_dict and info_dict["channel"]:
-                        unescaped_add_description += "@ " + info_dict["channel"]
-                    if "uploader" in info_dict and info_dict["uploader"]:
-                        unescaped_add_description += " " + info_dict["uploader"]
-                    unescaped_add_description += "\n" + info_dict["description"][:800]
-                    add_description = escape_markdown(unescaped_add_description, version=1)
-        except Exception as exc:
-            print(exc)
-            logger.debug("%s failed: %s", cmd_name, url)
-            logger.debug(traceback.format_exc())
-            status = "failed"
-        if cookies_file:
-            cookies_download_file.close()
-            os.unlink(cookies_download_file.name)
-        # gc.collect()
-
-    if status == "failed":
-        run_async(bot.send_message(chat_id=chat_id, reply_to_message_id=reply_to_message_id, text=FAILED_TEXT, parse_mode="Markdown"))
-    elif status == "timeout":
-        run_async(bot.send_message(chat_id=chat_id, reply_to_message_id=reply_to_message_id, text=DL_TIMEOUT_TEXT, parse_mode="Markdown"))
-    elif status == "success":
-        file_list = []
-        for d, dirs, files in os.walk(download_dir):
-            for file in files:
-                file_list.append(os.path.join(d, file))
-        if not file_list:
-            logger.debug("No files in dir: %s", download_dir)
+                logger.debug("Splitting: %s", file)
+                # We cut all parts in one ffmpeg pass with segment muxer instead of seeking and probing for each part:
+                # https://ffmpeg.org/ffmpeg-formats.html#segment_002c-stream_005fsegment_002c-ssegment
+                # https://github.com/c0decracker/video-splitter
+                # https://superuser.com/a/1354956/464797
+                stage_started = time.monotonic()
+                try:
+                    media = media_inspector.inspect(file)
+                    id3 = media["id3"]
+                    # Each part gets the same ID3 tags (with artwork), and bitrate is not constant, so we aim parts a bit below the limit:
+                    id3_size = getattr(id3, "size", 0) if id3 else 0
+                    parts_number = math.ceil(file_size / ((MAX_TG_FILE_SIZE - id3_size) * SPLIT_PART_SIZE_RATIO))
+                    segment_time = media["duration"] / parts_number
+                    # Segment muxer output filename is a template, so we escape "%" in file name:
+                    part_root = os.path.join(work_dir, os.path.basename(file_root))
+                    file_part_template = part_root.replace("%", "%%") + ".part%d" + file_ext
+                    ffinput = ffmpeg.input(file)
+                    ffmpeg.output(
+                        ffinput, file_part_template, codec="copy", vn=None, f="segment", segment_time=segment_time, segment_start_number=1, reset_timestamps=1, threads=1
+                    ).run()
+                    part_number = 1
+                    file_part = part_root + ".part{}{}".format(str(part_number), file_ext)
+                    while os.path.exists(file_part):
+                        if id3:
+                            try:
+                                id3.save(file_part, v1=ID3v1SaveOptions.CREATE, v2_version=4)
+                            except:
+                                pass
+                        if os.path.getsize(file_part) > MAX_TG_FILE_SIZE:
+                            raise FileSplittedPartiallyError(file_parts)
+                        file_parts.append(file_part)
+                        part_number += 1
+                        file_part = part_root + ".part{}{}".format(str(part_number), file_ext)
+                    if not file_parts:
+                        raise FileSplittedPartiallyError(file_parts)
+                    add_stage_metric(metrics, "split", "success", stage_started)
+                except Exception:
+                    add_stage_metric(metrics, "split", "failed", stage_started)
+                    raise FileSplittedPartiallyError(file_parts)
+
+        except FileNotSupportedError as exc:
+            # If format is not some extra garbage from downloaders:
+            if not (exc.file_format in ["m3u", "jpg", "jpeg", "png", "finished", "tmp"]):
+                logger.debug("Unsupported file format: %s", file_name)
+                cacheable = False
+                run_async(
+                    bot.send_message(
+                        chat_id=chat_id,
+                        reply_to_message_id=reply_to_message_id,
+                        text="*Sorry*, downloaded file `{}` is in format I could not yet convert or send".format(file_name),
+                        parse_mode="Markdown",
+                    )
+                )
+        except FileTooLargeError as exc:
+            cacheable = False
+            logger.debug("Large file for convert: %s", file_name)
+            run_async(
+                bot.send_message(
+                    chat_id=chat_id,
+                    reply_to_message_id=reply_to_message_id,
+                    text="*Sorry*, downloaded file `{}` is `{}` MB and it is larger than I could convert (`{} MB`)".format(
+                        file_name, exc.file_size // 1000000, MAX_CONVERT_FILE_SIZE // 1000000
+                    ),
+                    parse_mode="Markdown",
+                )
+            )
+        except FileSplittedPartiallyError as exc:
+            cacheable = False
+            file_parts = exc.file_parts
+            logger.debug("Splitting failed: %s", file_name)
             run_async(
                 bot.send_message(
-                    chat_id=chat_id, reply_to_message_id=reply_to_message_id, text="*Sorry*, I couldn't download any files from some of the provided links", parse_mode="Markdown"
+                    chat_id=chat_id,
+                    reply_to_message_id=reply_to_message_id,
+                    text="*Sorry*, I do not have enough resources to convert the file `{}`..".format(file_name),
+                    parse_mode="Markdown",
                 )
             )
+        except FileNotConvertedError as exc:
+            cacheable = False
+            logger.debug("Splitting failed: %s", file_name)
+            run_async(
+                bot.send_message(
+                    chat_id=chat_id,
+                    reply_to_message_id=reply_to_message_id,
+                    text="*Sorry*, I do not have enough resources to convert the file `{}`..".format(file_name),
+                    parse_mode="Markdown",
+                )
+            )
+        # We always build caption, because sent file_ids are cached and may be resent to chats with flood enabled:
+        addition = ""
+        if site_info.site == "youtube":
+            source = "YouTube"
+            file_root, file_ext = os.path.splitext(file_name)
+            file_title = file_root.replace(file_ext, "")
+            addition = ": " + file_title
+        elif site_info.site == "soundcloud":
+            source = "SoundCloud"
+        elif site_info.site == "bandcamp":
+            source = "Bandcamp"
         else:
-            for file in sorted(file_list):
-                file_name = os.path.split(file)[-1]
-                file_parts = []
+            source = url_obj.host.replace(".com", "").replace(".ru", "").replace("www.", "").replace("m.", "")
+        # TODO fix youtube id in [] ?
+        caption = "@{} _got it from_ [{}]({}){}".format(bot.username.replace("_", r"\_"), source, url, addition.replace("_", r"\_"))
+        if add_description:
+            caption += add_description
+        # logger.debug(caption)
+        reply_to_message_id_send = None
+        if flood:
+            reply_to_message_id_send = reply_to_message_id
+        sent_audio_ids = []
+        for index, file_part in enumerate(file_parts):
+            file_name = os.path.split(file_part)[-1]
+            # file_name = translit(file_name, 'ru', reversed=True)
+            logger.debug("Sending: %s", file_name)
+            run_async(bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_VOICE))
+            caption_part = None
+            if len(file_parts) > 1:
+                caption_part = "Part {} of {}".format(str(index + 1), str(len(file_parts)))
+            caption_full = get_caption_full(caption_part, caption if flood else None)
+            # caption_full = textwrap.shorten(caption_full, width=190, placeholder="..")
+            stage_started = time.monotonic()
+            sent_parts_number = len(sent_items)
+            upload_seconds = 0
+            local_path = None
+            if TG_BOT_API_LOCAL_MODE:
+                # Local Bot API server reads file from disk by itself, nothing is uploaded or copied:
+                local_path = place_for_local_bot_api(file_part)
+            try:
+                media = media_inspector.inspect(file_part)
+            except Exception:
+                # File is still sent, Telegram gets its properties by itself:
+                logger.debug("Inspecting failed: %s", file_part)
+                media = {"duration": None, "width": None, "height": None, "performer": None, "title": None}
+            duration = None
+            if media["duration"] is not None:
+                duration = round(media["duration"])
+            for attempt in range(1, TG_SEND_MAX_ATTEMPTS + 1):
+                # Opened file is streamed from disk in chunks by request backend, not read into memory:
+                upload_file = None
+                attempt_started = time.monotonic()
                 try:
-                    file_root, file_ext = os.path.splitext(file)
-                    file_format = file_ext.replace(".", "").lower()
-                    file_size = os.path.getsize(file)
-                    if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
-                        raise FileNotSupportedError(file_format)
-                    # We convert if downloaded file is video (except tiktok, instagram, twitter):
-                    if file_format in VIDEO_FORMATS and not download_video:
-                        if file_size > MAX_CONVERT_FILE_SIZE:
-                            raise FileTooLargeError(file_size)
-                        logger.debug("Converting video format: %s", file)
-                        try:
-                            file_converted = file.replace(file_ext, ".mp3")
-                            ffinput = ffmpeg.input(file)
-                            # https://kkroening.github.io/ffmpeg-python/#ffmpeg.output
-                            # We could set audio_bitrate="320k", but we don't need it now
-                            ffmpeg.output(ffinput, file_converted, vn=None, threads=1).run()
-                            file = file_converted
-                            file_root, file_ext = os.path.splitext(file)
-                            file_format = file_ext.replace(".", "").lower()
-                            file_size = os.path.getsize(file)
-                        except Exception:
-                            raise FileNotConvertedError
-
-                    file_parts = []
-                    if file_size <= MAX_TG_FILE_SIZE:
-                        file_parts.append(file)
-                    else:
-                        logger.debug("Splitting: %s", file)
-                        id3 = None
-                        try:
-                            id3 = ID3(file, translate=False)
-                        except:
-                            pass
-
-                        parts_number = file_size // MAX_TG_FILE_SIZE + 1
-
-                        # https://github.com/c0decracker/video-splitter
-                        # https://superuser.com/a/1354956/464797
-                        try:
-                            # file_duration = float(ffmpeg.probe(file)['format']['duration'])
-                            part_size = file_size // parts_number
-                            cur_position = 0
-                            for i in range(parts_number):
-                                file_part = file.replace(file_ext, ".part{}{}".format(str(i + 1), file_ext))
-                                ffinput = ffmpeg.input(file)
-                                if i == (parts_number - 1):
-                                    ffmpeg.output(ffinput, file_part, codec="copy", vn=None, ss=cur_position, threads=1).run()
-                                else:
-                                    ffmpeg.output(ffinput, file_part, codec="copy", vn=None, ss=cur_position, fs=part_size, threads=1).run()
-                                    part_duration = float(ffmpeg.probe(file_part)["format"]["duration"])
-                                    cur_position += part_duration
-                                if id3:
-                                    try:
-                                        id3.save(file_part, v1=ID3v1SaveOptions.CREATE, v2_version=4)
-                                    except:
-                                        pass
-                                file_parts.append(file_part)
-                        except Exception:
-                            raise FileSplittedPartiallyError(file_parts)
-
-                except FileNotSupportedError as exc:
-                    # If format is not some extra garbage from downloaders:
-                    if not (exc.file_format in ["m3u", "jpg", "jpeg", "png", "finished", "tmp"]):
-                        logger.debug("Unsupported file format: %s", file_name)
-                        run_async(
-                            bot.send_message(
+                    logger.debug(f"Trying {attempt} time to send file part: {file_part}")
+                    if file_part.endswith(".mp3"):
+                        if local_path:
+                            audio = get_local_bot_api_uri(local_path)
+                            logger.debug(audio)
+                        else:
+                            upload_file = open(file_part, "rb")
+                            audio = InputFile(upload_file, filename=file_name, read_file_handle=False)
+                        # Bot.send_audio() has connection troubles when running async in parallel:
+                        # Works bad on my computer with official API (good with high timeout)
+                        # Works good on server with local API.
+                        audio_msg = run_async(
+                            bot.send_audio(
                                 chat_id=chat_id,
-                                reply_to_message_id=reply_to_message_id,
-                                text="*Sorry*, downloaded file `{}` is in format I could not yet convert or send".format(file_name),
+                                reply_to_message_id=reply_to_message_id_send,
+                                audio=audio,
+                                duration=duration,
+                                performer=media["performer"],
+                                title=media["title"],
+                                caption=caption_full,
                                 parse_mode="Markdown",
-                            )
-                        )
-                except FileTooLargeError as exc:
-                    logger.debug("Large file for convert: %s", file_name)
-                    run_async(
-                        bot.send_message(
-                            chat_id=chat_id,
-                            reply_to_message_id=reply_to_message_id,
-                            text="*Sorry*, downloaded file `{}` is `{}` MB and it is larger than I could convert (`{} MB`)".format(
-                                file_name, exc.file_size // 1000000, MAX_CONVERT_FILE_SIZE // 1000000
+                                read_timeout=COMMON_CONNECTION_TIMEOUT,
+                                write_timeout=COMMON_CONNECTION_TIMEOUT,
+                                connect_timeout=COMMON_CONNECTION_TIMEOUT,
+                                pool_timeout=COMMON_CONNECTION_TIMEOUT,
                             ),
-                            parse_mode="Markdown",
-                        )
-                    )
-                except FileSplittedPartiallyError as exc:
-                    file_parts = exc.file_parts
-                    logger.debug("Splitting failed: %s", file_name)
-                    run_async(
-                        bot.send_message(
-                            chat_id=chat_id,
-                            reply_to_message_id=reply_to_message_id,
-                            text="*Sorry*, I do not have enough resources to convert the file `{}`..".format(file_name),
-                            parse_mode="Markdown",
                         )
-                    )
-                except FileNotConvertedError as exc:
-                    logger.debug("Splitting failed: %s", file_name)
-                    run_async(
-                        bot.send_message(
-                            chat_id=chat_id,
-                            reply_to_message_id=reply_to_message_id,
-                            text="*Sorry*, I do not have enough resources to convert the file `{}`..".format(file_name),
-                            parse_mode="Markdown",
-                        )
-                    )
-                caption = None
-                reply_to_message_id_send = None
-                if flood:
-                    addition = ""
-                    if DOMAIN_YT in host or DOMAIN_YT_BE in host:
-                        source = "YouTube"
-                        file_root, file_ext = os.path.splitext(file_name)
-                        file_title = file_root.replace(file_ext, "")
-                        addition = ": " + file_title
-                    elif DOMAIN_SC in host or DOMAIN_SC_GOOGL in host:
-                        source = "SoundCloud"
-                    elif DOMAIN_BC in host:
-                        source = "Bandcamp"
-                    else:
-                        source = url_obj.host.replace(".com", "").replace(".ru", "").replace("www.", "").replace("m.", "")
-                    # TODO fix youtube id in [] ?
-                    caption = "@{} _got it from_ [{}]({}){}".format(bot.username.replace("_", r"\_"), source, url, addition.replace("_", r"\_"))
-                    if add_description:
-                        caption += add_description
-                    # logger.debug(caption)
-                    reply_to_message_id_send = reply_to_message_id
-                sent_audio_ids = []
-                for index, file_part in enumerate(file_parts):
-                    path = pathlib.Path(file_part)
-                    file_name = os.path.split(file_part)[-1]
-                    # file_name = translit(file_name, 'ru', reversed=True)
-                    logger.debug("Sending: %s", file_name)
-                    run_async(bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_VOICE))
-                    caption_part = None
-                    if len(file_parts) > 1:
-                        caption_part = "Part {} of {}".format(str(index + 1), str(len(file_parts)))
-                    if caption:
-                        if caption_part:
-                            caption_full = caption_part + " | " + caption
+                        if upload_file:
+                            upload_seconds = time.monotonic() - attempt_started
+                        sent_audio_ids.append(audio_msg.audio.file_id)
+                        sent_items.append({"type": "audio", "file_id": audio_msg.audio.file_id, "caption_part": caption_part, "caption": caption})
+                        logger.debug("Sending audio succeeded: %s", file_name)
+                        break
+                    elif download_video:
+                        if local_path:
+                            video = get_local_bot_api_uri(local_path)
+                            logger.debug(video)
                         else:
-                            caption_full = caption
-                    else:
-                        if caption_part:
-                            caption_full = caption_part
-                        else:
-                            caption_full = ""
-                    # caption_full = textwrap.shorten(caption_full, width=190, placeholder="..")
-                    retries = 3
-                    for i in range(retries):
-                        try:
-                            logger.debug(f"Trying {i+1} time to send file part: {file_part}")
-                            if file_part.endswith(".mp3"):
-                                mp3 = MP3(file_part)
-                                duration = round(mp3.info.length)
-                                performer = None
-                                title = None
-                                try:
-                                    performer = ", ".join(mp3["artist"])
-                                    title = ", ".join(mp3["title"])
-                                except:
-                                    pass
-                                if TG_BOT_API_LOCAL_MODE:
-                                    audio = path.absolute().as_uri()
-                                    logger.debug(audio)
-                                else:
-                                    audio = open(file_part, "rb")
-                                # Bot.send_audio() has connection troubles when running async in parallel:
-                                # Works bad on my computer with official API (good with high timeout)
-                                # Works good on server with local API.
-                                audio_msg = run_async(
-                                    bot.send_audio(
-                                        chat_id=chat_id,
-                                        reply_to_message_id=reply_to_message_id_send,
-                                        audio=audio,
-                                        duration=duration,
-                                        performer=performer,
-                                        title=title,
-                                        caption=caption_full,
-                                        parse_mode="Markdown",
-                                        read_timeout=COMMON_CONNECTION_TIMEOUT,
-                                        write_timeout=COMMON_CONNECTION_TIMEOUT,
-                                        connect_timeout=COMMON_CONNECTION_TIMEOUT,
-                                        pool_timeout=COMMON_CONNECTION_TIMEOUT,
-                                    ),
-                                )
-                                sent_audio_ids.append(audio_msg.audio.file_id)
-                                logger.debug("Sending audio succeeded: %s", file_name)
-                                break
-                            elif download_video:
-                                video = open(file_part, "rb")
-                                duration = int(float(ffmpeg.probe(file_part)["format"]["duration"]))
-                                videostream = next(item for item in ffmpeg.probe(file_part)["streams"] if item["codec_type"] == "video")
-                                width = int(videostream["width"])
-                                height = int(videostream["height"])
-                                video_msg = run_async(
-                                    bot.send_video(
-                                        chat_id=chat_id,
-                                        reply_to_message_id=reply_to_message_id_send,
-                                        video=video,
-                                        supports_streaming=True,
-                                        duration=duration,
-                                        width=width,
-                                        height=height,
-                                        caption=caption_full,
-                                        parse_mode="Markdown",
-                                        read_timeout=COMMON_CONNECTION_TIMEOUT,
-                                        write_timeout=COMMON_CONNECTION_TIMEOUT,
-                                        connect_timeout=COMMON_CONNECTION_TIMEOUT,
-                                        pool_timeout=COMMON_CONNECTION_TIMEOUT,
-                                    ),
-                                )
-                                sent_audio_ids.append(video_msg.video.file_id)
-                                logger.debug("Sending video succeeded: %s", file_name)
-                                break
-                        except TelegramError:
-                            ### ??? print(traceback.format_exc())
-                            if i == retries - 1:
-                                logger.debug("Sending failed because of TelegramError: %s", file_name)
-                            else:
-                                time.sleep(5)
-                if len(sent_audio_ids) != len(file_parts):
+                            upload_file = open(file_part, "rb")
+                            video = InputFile(upload_file, filename=file_name, read_file_handle=False)
+                        video_msg = run_async(
+                            bot.send_video(
+                                chat_id=chat_id,
+                                reply_to_message_id=reply_to_message_id_send,
+                                video=video,
+                                supports_streaming=True,
+                                duration=duration,
+                                width=media["width"],
+                                height=media["height"],
+                                caption=caption_full,
+                                parse_mode="Markdown",
+                                read_timeout=COMMON_CONNECTION_TIMEOUT,
+                                write_timeout=COMMON_CONNECTION_TIMEOUT,
+                                connect_timeout=COMMON_CONNECTION_TIMEOUT,
+                                pool_timeout=COMMON_CONNECTION_TIMEOUT,
+                            ),
+                        )
+                        if upload_file:
+                            upload_seconds = time.monotonic() - attempt_started
+                        sent_audio_ids.append(video_msg.video.file_id)
+                        sent_items.append({"type": "video", "file_id": video_msg.video.file_id, "caption_part": caption_part, "caption": caption})
+                        logger.debug("Sending video succeeded: %s", file_name)
+                        break
+                except TelegramError as exc:
+                    error = type(exc).__name__
+                    delay = get_telegram_retry_delay(exc, attempt)
+                    if delay is None or attempt == TG_SEND_MAX_ATTEMPTS:
+                        logger.debug("Sending failed because of %s: %s", error, file_name)
+                        metrics["telegram_errors"].append((error, "give_up"))
+                        break
+                    logger.debug("Sending failed because of %s, retrying in %.1f s: %s", error, delay, file_name)
+                    metrics["telegram_errors"].append((error, "retry"))
+                    time.sleep(delay)
+                finally:
+                    if upload_file:
+                        upload_file.close()
+            if local_path:
+                remove_from_spool(local_path)
+            if len(sent_items) > sent_parts_number:
+                add_stage_metric(metrics, "upload", "success", stage_started)
+                file_part_size = os.path.getsize(file_part)
+                metrics["uploaded_bytes"] += file_part_size
+                if upload_seconds:
+                    metrics["upload_speeds"].append(file_part_size / upload_seconds)
+                    logger.debug("Uploaded %s at %.2f MB/s", file_name, file_part_size / upload_seconds / 1000000)
+            else:
+                add_stage_metric(metrics, "upload", "failed", stage_started)
+        if len(sent_audio_ids) != len(file_parts):
+            cacheable = False
+            run_async(
+                bot.send_message(
+                    chat_id=chat_id,
+                    reply_to_message_id=reply_to_message_id,
+                    text="*Sorry*, could not send file `{}` or some of it's parts..".format(file_name),
+                    parse_mode="Markdown",
+                )
+            )
+            logger.debug("Sending some parts failed: %s", file_name)
+
+    # Finished files (playlist items) are converted and sent by sender thread while next ones are still downloading:
+    file_queue = queue.Queue()
+    queued_files = set()
+
+    def send_files():
+        nonlocal cacheable
+        while True:
+            item = file_queue.get()
+            if item is None:
+                return
+            try:
+                send_file(*item)
+            except Exception:
+                cacheable = False
+                logger.debug("Sending file failed: %s", item[0])
+                logger.debug(traceback.format_exc())
+                try:
                     run_async(
                         bot.send_message(
                             chat_id=chat_id,
                             reply_to_message_id=reply_to_message_id,
-                            text="*Sorry*, could not send file `{}` or some of it's parts..".format(file_name),
+                            text="*Sorry*, could not send file `{}` or some of it's parts..".format(os.path.basename(item[0])),
                             parse_mode="Markdown",
                         )
                     )
-                    logger.debug("Sending some parts failed: %s", file_name)
+                except TelegramError:
+                    pass
 
-    shutil.rmtree(download_dir, ignore_errors=True)
-    if wait_message_id:
+    def queue_finished_file(file, description=""):
+        if file in queued_files:
+            return
+        try:
+            file_size = os.path.getsize(file)
+        except OSError:
+            # Downloader has just renamed or removed it:
+            return
+        queued_files.add(file)
+        metrics["downloaded_bytes"] += file_size
+        file_queue.put((file, description))
+
+    def queue_finished_files(skip_newest=False):
+        files = [os.path.join(d, file) for d, dirs, files in os.walk(download_dir) if not d.startswith(work_dir) for file in files]
+        files_mtimes = []
+        for file in files:
+            if file in queued_files:
+                continue
+            try:
+                files_mtimes.append((os.path.getmtime(file), file))
+            except OSError:
+                continue
+        files = [file for mtime, file in sorted(files_mtimes)]
+        if skip_newest:
+            # Downloader is still running, so the newest file and temporary files may be still written:
+            files = [file for file in files[:-1] if not is_partial_file(file)]
+        for file in files:
+            queue_finished_file(file, add_description)
+
+    sender = threading.Thread(target=send_files, name="Sender", daemon=True)
+    sender.start()
+    try:
+        cmd = None
+        cmd_name = ""
+        cmd_args = ()
+        cmd_input = None
+        if (site_info.site == "soundcloud" and site_info.domain != DOMAIN_SC_API) or (site_info.site == "bandcamp" and BCDL_ENABLE):
+            # If link is sc/bc, we try scdl/bcdl first:
+            if site_info.site == "soundcloud":
+                cmd = scdl_bin
+                cmd_name = str(cmd)
+                cmd_args = (
+                    "-l",
+                    url,  # URL of track/playlist/user
+                    "-c",  # Continue if a music already exist
+                    "--path",
+                    download_dir,  # Download the music to a custom path
+                    "--onlymp3",  # Download only the mp3 file even if the track is Downloadable
+                    "--addtofile",  # Add the artist name to the filename if it isn't in the filename already
+                    "--addtimestamp",
+                    # Adds the timestamp of the creation of the track to the title (useful to sort chronologically)
+                    "--no-playlist-folder",
+                    # Download playlist tracks into directory, instead of making a playlist subfolder
+                    "--extract-artist",  # Set artist tag from title instead of username
+                )
+                cmd_input = None
+            elif site_info.site == "bandcamp":
+                cmd = bcdl_bin
+                cmd_name = str(cmd)
+                cmd_args = (
+                    "--base-dir",
+                    download_dir,  # Base location of which all files are downloaded
+                    "--template",
+                    "%{track} - %{artist} - %{title} [%{album}]",  # Output filename template
+                    "--overwrite",  # Overwrite tracks that already exist
+                    "--group",  # Use album/track Label as iTunes grouping
+                    "--embed-art",  # Embed album art (if available)
+                    "--no-slugify",  # Disable slugification of track, album, and artist names
+                    url,  # URL of album/track
+                )
+                cmd_input = "yes"
+
+            env = None
+            if proxy:
+                env = {"http_proxy": proxy, "https_proxy": proxy}
+            logger.debug("%s starts: %s", cmd_name, url)
+            stage_started = time.monotonic()
+            stage_outcome = "failed"
+            # Output goes to temporary files, so pipes don't get full while we watch download dir:
+            cmd_stdout_file = tempfile.TemporaryFile(mode="w+")
+            cmd_stderr_file = tempfile.TemporaryFile(mode="w+")
+            cmd_proc = cmd[cmd_args].popen(env=env, stdin=PIPE, stdout=cmd_stdout_file, stderr=cmd_stderr_file, universal_newlines=True)
+            try:
+                if cmd_input:
+                    cmd_proc.stdin.write(cmd_input)
+                cmd_proc.stdin.close()
+                cmd_deadline = time.monotonic() + DL_TIMEOUT
+                while True:
+                    try:
+                        cmd_retcode = cmd_proc.wait(timeout=1)
+                        break
+                    except TimeoutExpired:
+                        if time.monotonic() > cmd_deadline:
+                            raise
+                        queue_finished_files(skip_newest=True)
+                cmd_stdout_file.seek(0)
+                cmd_stdout = cmd_stdout_file.read()
+                cmd_stderr_file.seek(0)
+                cmd_stderr = cmd_stderr_file.read()
+                # listed are common scdl problems for one track with 0 retcode, all its log output goes to stderr (track may be in stdout):
+                # https://github.com/scdl-org/scdl/issues/493
+                # https://github.com/scdl-org/scdl/pull/494
+                if cmd_retcode or (any(err in cmd_stderr for err in ["Error resolving url", "is not streamable", "Failed to get item"]) and ".mp3" not in cmd_stderr):
+                    raise ProcessExecutionError(cmd_args, cmd_retcode, cmd_stdout, cmd_stderr)
+                logger.debug("%s succeeded: %s", cmd_name, url)
+                status = "success"
+                stage_outcome = "success"
+            except TimeoutExpired:
+                cmd_proc.kill()
+                logger.debug("%s took too much time and dropped: %s", cmd_name, url)
+                stage_outcome = "timeout"
+            except ProcessExecutionError:
+                logger.debug("%s failed: %s", cmd_name, url)
+                logger.debug(traceback.format_exc())
+            finally:
+                if cmd_proc.poll() is None:
+                    cmd_proc.kill()
+                cmd_stdout_file.close()
+                cmd_stderr_file.close()
+            if status != "success" and queued_files:
+                # Some tracks were already sent, so we don't start over with ydl:
+                status = stage_outcome
+            add_stage_metric(metrics, "download", stage_outcome, stage_started)
+
+        if status == "initial":
+            # If link is not sc/bc or scdl/bcdl just failed, we use ydl
+            cmd_name = "ydl_download"
+            # https://github.com/yt-dlp/yt-dlp/blob/master/yt_dlp/YoutubeDL.py#L187
+            # https://github.com/yt-dlp/yt-dlp/blob/master/yt_dlp/utils/_utils.py
+            ydl_opts = {
+                # https://github.com/yt-dlp/yt-dlp#output-template
+                # Default outtmpl is "%(title)s [%(id)s].%(ext)s"
+                # Take first 16 symbols of title:
+                "outtmpl": os.path.join(download_dir, "%(playlist_index|)03d%(playlist_index&_|)s%(title).16s [%(id)s].%(ext)s"),
+                "restrictfilenames": True,
+                "windowsfilenames": True,
+                "max_filesize": MAX_TG_FILE_SIZE * 3,
+                # "js_runtimes": {"node": {}},
+                # TODO Add optional parameter FFMPEG_PATH:
+                # "ffmpeg_location": "/home/gpchelkin/.local/bin/",
+                # "ffmpeg_location": "/usr/local/bin/",
+                # "trim_file_name": 32,
+            }
+            if site_info.site in ["tiktok", "twitter"]:
+                download_video = True
+                ydl_opts["format"] = "mp4"
+            elif site_info.site == "instagram":
+                download_video = True
+                ydl_opts.update(
+                    {
+                        "format": "mp4",
+                        "postprocessors": [
+                            # Instagram usually gives VP9 or HEVC (x265/h265) video codec (when downloading with cookies).
+                            #   VP9 doesn't play in Telegram iOS client;
+                            #   HEVC seems to be used for 4K (2160*3840) videos, and yt-dlp fails converting them (maybe because of MAX_MEM). TODO Check for HEVC and skip converting?
+                            # We need to convert it to AVC (x264/h264) or HEVC (x265/h265) video (+ AAC audio).
+                            # We went with AVC (x264/h264) for now.
+                            # "FFmpegVideoConvertor" doesn't work here since the original file is already in mp4 format.
+                            # We don't touch audio and just copy it here since it's probably OK in original. But we may want to change 'copy' to 'aac' later.
+                            # yt-dlp --use-postprocessor FFmpegCopyStream --ppa copystream:"-codec:v libx264 -crf 24 -preset veryfast -codec:a copy -f mp4 -threads 1" ...
+                            # https://github.com/yt-dlp/yt-dlp/issues/7607
+                            # https://github.com/yt-dlp/yt-dlp/issues/5859
+                            # https://github.com/yt-dlp/yt-dlp/issues/8904
+                            # https://github.com/yt-dlp/yt-dlp/blob/master/devscripts/cli_to_api.py
+                            # {"key": "FFmpegVideoConvertor", "preferedformat": "mp4"},
+                            {"key": "FFmpegCopyStream"},
+                        ],
+                        "postprocessor_args": {
+                            "copystream": ["-codec:v", "libx264", "-crf", "24", "-preset", "veryfast", "-codec:a", "copy", "-f", "mp4", "-threads", "1"],
+                        },
+                    }
+                )
+            else:
+                ydl_opts.update(
+                    {
+                        "format": "bestaudio/best",
+                        "postprocessors": [
+                            {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "320"},
+                            {"key": "FFmpegMetadata"},
+                            {"key": "EmbedThumbnail", 'already_have_thumbnail': False},
+                        ],
+                        "postprocessor_args": {
+                            "ExtractAudio": ["-threads", "1"],
+                            "extractaudio": ["-threads", "1"],
+                        },
+                        # https://old.reddit.com/r/youtubedl/comments/zh61bw/goal_is_to_download_audio_only_and_embed/
+                        "writethumbnail": True,
+                        "noplaylist": True,
+                    }
+                )
+            if proxy:
+                ydl_opts["proxy"] = proxy
+            if source_ip:
+                ydl_opts["source_address"] = source_ip
+            # Cookies copy is placed next to download directory, so it doesn't get sent:
+            set_ydl_cookies_opts(ydl_opts, cookies_file, download_dir + ".cookies.txt")
+
+            # Only postprocessors (ffmpeg) hold transcode slot, not network download itself:
+            transcode_slot = TranscodeSlot(metrics)
+            ydl_opts["postprocessor_hooks"] = [transcode_slot.ydl_hook]
+
+            logger.debug("%s starts: %s", cmd_name, url)
+            stage_started = time.monotonic()
+            try:
+                # FIXME Check and proceed even with partial results - e.g. for playlists with only some videos failed (private or more) https://youtube.com/playlist?list=PL2C109776112A2BB3
+                # https://github.com/yt-dlp/yt-dlp/blob/master/README.md#embedding-examples
+                # Single extractor round-trip: the same info dict is used for description in caption.
+                with ydl.YoutubeDL(ydl_opts) as ydl_instance:
+                    ydl_instance.add_post_processor(get_ydl_finished_file_pp(queue_finished_file, download_video, media_inspector), when="after_move")
+                    if FIT_TO_LIMIT and not download_video:
+                        ydl_instance.add_post_processor(get_ydl_fit_bitrate_pp(), when="pre_process")
+                    info_dict = ydl_instance.sanitize_info(ydl_instance.extract_info(url, download=True))
+                logger.debug("%s succeeded: %s", cmd_name, url)
+                status = "success"
+                if download_video and info_dict:
+                    add_description = get_ydl_description(info_dict)
+            except Exception as exc:
+                print(exc)
+                logger.debug("%s failed: %s", cmd_name, url)
+                logger.debug(traceback.format_exc())
+                status = "failed"
+                egress_error = get_egress_error(str(exc), site_info.site)
+            finally:
+                transcode_slot.release()
+            add_stage_metric(metrics, "download", status, stage_started)
+            # gc.collect()
+
+        if status == "success":
+            # Files left in download dir are sent too, e.g. if they were not reported by downloader:
+            queue_finished_files()
+    finally:
+        # Sender thread must not wait for files forever, even if downloading failed unexpectedly:
+        file_queue.put(None)
+        sender.join()
+    if status == "failed" and egress_retry and egress_error and not queued_files:
+        # Main process retries it on another proxy or source IP, so user doesn't get failure yet:
+        logger.debug("%s failed because of %s error, leaving for retry: %s", cmd_name, egress_error, url)
+        status = "egress_failed"
+        cacheable = False
+    if status in ["failed", "timeout"]:
+        # Some playlist items may have been sent already:
+        cacheable = False
+        text = FAILED_TEXT if status == "failed" else DL_TIMEOUT_TEXT
+        run_async(bot.send_message(chat_id=chat_id, reply_to_message_id=reply_to_message_id, text=text, parse_mode="Markdown"))
+    elif status == "success" and not queued_files:
+        logger.debug("No files in dir: %s", download_dir)
+        cacheable = False
+        run_async(
+            bot.send_message(
+                chat_id=chat_id, reply_to_message_id=reply_to_message_id, text="*Sorry*, I couldn't download any files from some of the provided links", parse_mode="Markdown"
+            )
+        )
+
+    remove_download_dir(download_dir)
+    # Retried download keeps wait message:
+    if wait_message_id and status != "egress_failed":
         try:
             run_async(
                 bot.delete_message(
@@ -1404,31 +2937,306 @@ def download_url_and_send(
             )
         except:
             pass
-    run_async(bot.shutdown())
+    rss, metrics["peak_rss"] = get_worker_rss()
+    WORKER_RECYCLE = rss > WORKER_RSS_HIGH_WATER
+    return {
+        "status": status,
+        "items": sent_items,
+        "cacheable": cacheable and status == "success" and bool(sent_items),
+        "metrics": metrics,
+        "worker": {"pid": os.getpid(), "rss": rss, "recycle": WORKER_RECYCLE},
+        "egress_error": egress_error,
+    }
+
+
+class SqlitePersistence(BasePersistence):
+    """Persistence in SQLite database (WAL mode), where every chat/user is a separate row.
+
+    Unlike PicklePersistence, which rewrites the whole file on every flush,
+    only rows which data actually changed are written.
+    """
+
+    def __init__(self, filepath, update_interval=60):
+        super().__init__(update_interval=update_interval)
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        self.conn = sqlite3.connect(filepath, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Commit doesn't wait for fsync in WAL mode, database still stays consistent:
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS data (kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, key))")
+        # Sent file_ids are kept apart from bot_data, so that caching one link writes one small row:
+        self.conn.execute("CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, items BLOB NOT NULL, time REAL NOT NULL, used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS file_ids_used ON file_ids (used)")
+        # Digests of stored values: (kind, key) -> digest, to skip writing unchanged ones:
+        self.digests = {}
+
+    def migrate_pickle(self, pickle_path):
+        """Load old PicklePersistence file into empty database once, then rename it."""
+        if not os.path.exists(pickle_path) or self.conn.execute("SELECT 1 FROM data LIMIT 1").fetchone():
+            return
+        try:
+            with open(pickle_path, "rb") as file:
+                data = pickle.load(file)
+        except Exception as exc:
+            logger.info("Could not load pickle file '%s' for migration, starting from scratch: %s", pickle_path, exc)
+            return
+        self.conn.execute("BEGIN")
+        for kind in ["user_data", "chat_data"]:
+            for key, value in (data.get(kind) or {}).items():
+                self.write(kind, key, value)
+        if data.get("bot_data") is not None:
+            self.write("bot_data", "", data["bot_data"])
+        if data.get("callback_data") is not None:
+            self.write("callback_data", "", data["callback_data"])
+        for name, conversation in (data.get("conversations") or {}).items():
+            self.write("conversations", name, conversation)
+        self.conn.execute("COMMIT")
+        os.replace(pickle_path, pickle_path + ".migrated")
+        logger.info("Pickle file '%s' migrated to '%s'", pickle_path, self.filepath)
+
+    def write(self, kind, key, value):
+        dumped = pickle.dumps(value)
+        digest = hashlib.blake2b(dumped, digest_size=16).digest()
+        if self.digests.get((kind, str(key))) == digest:
+            return
+        self.conn.execute("INSERT OR REPLACE INTO data (kind, key, value) VALUES (?, ?, ?)", (kind, str(key), dumped))
+        self.digests[(kind, str(key))] = digest
+
+    def read(self, kind):
+        values = {}
+        for key, dumped in self.conn.execute("SELECT key, value FROM data WHERE kind = ?", (kind,)):
+            self.digests[(kind, key)] = hashlib.blake2b(dumped, digest_size=16).digest()
+            values[key] = pickle.loads(dumped)
+        return values
+
+    def delete(self, kind, key):
+        self.conn.execute("DELETE FROM data WHERE kind = ? AND key = ?", (kind, str(key)))
+        self.digests.pop((kind, str(key)), None)
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in self.read("user_data").items()}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in self.read("chat_data").items()}
+
+    def get_file_ids(self, key):
+        row = self.conn.execute("SELECT items, time FROM file_ids WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > FILE_ID_CACHE_TTL:
+            self.drop_file_ids(key)
+            return None
+        # Least recently used entries are evicted first:
+        self.conn.execute("UPDATE file_ids SET used = ? WHERE key = ?", (time.time(), key))
+        return pickle.loads(row[0])
+
+    def put_file_ids(self, key, items):
+        now = time.time()
+        self.conn.execute("INSERT OR REPLACE INTO file_ids (key, items, time, used) VALUES (?, ?, ?, ?)", (key, pickle.dumps(items), now, now))
+        self.evict_file_ids()
+
+    def evict_file_ids(self):
+        self.conn.execute("DELETE FROM file_ids WHERE key IN (SELECT key FROM file_ids ORDER BY used DESC LIMIT -1 OFFSET ?)", (FILE_ID_CACHE_SIZE,))
+
+    def drop_file_ids(self, key):
+        self.conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    async def get_bot_data(self):
+        return self.read("bot_data").get("", {})
+
+    async def get_callback_data(self):
+        return self.read("callback_data").get("")
+
+    async def get_conversations(self, name):
+        return self.read("conversations").get(name, {})
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self.read("conversations").get(name, {})
+        if conversations.get(key) == new_state:
+            return
+        conversations[key] = new_state
+        self.write("conversations", name, conversations)
+
+    async def update_user_data(self, user_id, data):
+        self.write("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self.write("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data):
+        self.write("bot_data", "", data)
+
+    async def update_callback_data(self, data):
+        self.write("callback_data", "", data)
+
+    async def drop_chat_data(self, chat_id):
+        self.delete("chat_data", chat_id)
+
+    async def drop_user_data(self, user_id):
+        self.delete("user_data", user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Every write is already committed, so we just checkpoint WAL into database file:
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.close()
 
 
 async def post_shutdown(application: Application) -> None:
     # EXECUTOR.shutdown(wait=False, cancel_futures=True)
     EXECUTOR.stop()
     EXECUTOR.join(timeout=10)
+    for client in HTTP_CLIENTS.values():
+        await client.aclose()
 
 
 async def post_init(application: Application) -> None:
+    # Bot got its username by getMe in Application.initialize():
+    FORWARDED_FROM_BOT.add_usernames(application.bot.username)
+    if COOKIES_FILE:
+        # First downloads must already have cookies, so we fetch them before polling starts:
+        await callback_cookies_refresh(None)
+    STARTUP_SECONDS.labels(stage="ready").set(time.monotonic() - STARTED)
     SYSTEMD_NOTIFIER.notify("READY=1")
     SYSTEMD_NOTIFIER.notify(f"STATUS=Application initialized")
 
 
+async def first_update_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global FIRST_UPDATE_SEEN
+    if not FIRST_UPDATE_SEEN:
+        FIRST_UPDATE_SEEN = True
+        STARTUP_SECONDS.labels(stage="first_update").set(time.monotonic() - STARTED)
+
+
 async def callback_watchdog(context: ContextTypes.DEFAULT_TYPE):
     SYSTEMD_NOTIFIER.notify("WATCHDOG=1")
     SYSTEMD_NOTIFIER.notify(f"STATUS=Watchdog was sent {datetime.datetime.now()}")
 
 
 async def callback_monitor(context: ContextTypes.DEFAULT_TYPE):
-    logger.debug(f"EXECUTOR pending work items: {len(EXECUTOR._pending_work_items)} tasks remain")
-    EXECUTOR_TASKS_REMAINING.set(len(EXECUTOR._pending_work_items))
+    logger.debug(f"SCHEDULER jobs: {SCHEDULER.jobs} running, {SCHEDULER.pending()} pending")
+    EXECUTOR_TASKS_REMAINING.set(SCHEDULER.jobs + SCHEDULER.pending())
+
+
+async def callback_ask_sweep(context: ContextTypes.DEFAULT_TYPE):
+    expired = time.time() - ASK_TTL
+    stale_chats = {}
+    for chat_id, chat_data in context.application.chat_data.items():
+        stale_asks = [ask for ask in get_ask_entries(chat_data) if ask[1].get("time", 0) < expired]
+        if stale_asks:
+            stale_chats[chat_id] = stale_asks
+    for chat_id, stale_asks in stale_chats.items():
+        await forget_asks(context.bot, chat_id, context.application.chat_data[chat_id], stale_asks)
+    if stale_chats:
+        logger.debug("Forgot stale questions in %s chats", len(stale_chats))
+        # Job has no chat, so we tell which chats data to persist:
+        context.application.mark_data_for_update_persistence(chat_ids=list(stale_chats))
+
+
+async def callback_janitor(context: ContextTypes.DEFAULT_TYPE):
+    used, free = await asyncio.to_thread(sweep_download_dirs)
+    paused = bool(MIN_FREE_SPACE) and free < MIN_FREE_SPACE
+    if paused != SCHEDULER.paused:
+        logger.warning("Downloads are %s, free space on DL_DIR disk: %s MiB", "paused" if paused else "resumed", free // (1024 * 1024))
+        SCHEDULER.paused = paused
+        SCHEDULER.pump()
+
+
+async def callback_job_broker_poll(context: ContextTypes.DEFAULT_TYPE):
+    BROKER_JOBS.poll()
+
+
+async def callback_queue_positions(context: ContextTypes.DEFAULT_TYPE):
+    # Started jobs were showing queue position, now they are downloading:
+    started_jobs, SCHEDULER.started_jobs = SCHEDULER.started_jobs, []
+    for job in started_jobs:
+        try:
+            await context.bot.edit_message_text(chat_id=job["chat_id"], message_id=job["wait_message_id"], parse_mode="Markdown", text=f"_{get_random_wait_text()}_")
+        except TelegramError:
+            pass
+    # Several links from one message share wait message, so we show position of the first one:
+    wait_messages = set()
+    for position, job in enumerate(SCHEDULER.ordered_jobs(), start=1):
+        wait_message = (job["chat_id"], job["wait_message_id"])
+        if not job["wait_message_id"] or wait_message in wait_messages:
+            continue
+        wait_messages.add(wait_message)
+        if job["position"] == position:
+            continue
+        job["position"] = position
+        wait_minutes = max(1, round(SCHEDULER.estimate_wait(position) / 60))
+        try:
+            await context.bot.edit_message_text(
+                chat_id=job["chat_id"], message_id=job["wait_message_id"], parse_mode="Markdown", text=QUEUE_POSITION_TEXT.format(position, wait_minutes)
+            )
+        except TelegramError:
+            pass
+
+
+def get_cookies_file():
+    # Cookies file spec for workers: local path or firefox profile, workers never download cookies by themselves.
+    if not COOKIES_FILE:
+        return None
+    if COOKIES_FILE.startswith("http"):
+        if os.path.exists(COOKIES_CACHE_FILE):
+            return COOKIES_CACHE_FILE
+        return None
+    if COOKIES_FILE.startswith("firefox:"):
+        return ":".join(COOKIES_FILE.split(":", maxsplit=2)[:2])
+    return COOKIES_FILE
+
+
+async def callback_cookies_refresh(context: ContextTypes.DEFAULT_TYPE):
+    if COOKIES_FILE.startswith("http"):
+        # URL for downloading cookie file:
+        cookies_url = COOKIES_FILE
+        cookies_path = pathlib.Path(COOKIES_CACHE_FILE)
+    elif COOKIES_FILE.startswith("firefox:") and len(COOKIES_FILE.split(":", maxsplit=2)) == 3:
+        # URL for downloading cookie sqlite file to firefox profile:
+        _, firefox_profile, cookies_url = COOKIES_FILE.split(":", maxsplit=2)
+        cookies_path = pathlib.Path.home() / ".mozilla" / "firefox" / firefox_profile / "cookies.sqlite"
+    else:
+        return
+    headers = {}
+    if cookies_path.exists():
+        if COOKIES_STATE["etag"]:
+            headers["If-None-Match"] = COOKIES_STATE["etag"]
+        if COOKIES_STATE["last_modified"]:
+            headers["If-Modified-Since"] = COOKIES_STATE["last_modified"]
+    try:
+        r = await get_http_client().get(cookies_url, headers=headers)
+        if r.status_code == 304:
+            logger.debug("Cookies file not modified: %s", cookies_path)
+            # Keep it fresh for tmpreaper:
+            cookies_path.touch()
+            return
+        r.raise_for_status()
+    except httpx.HTTPError:
+        logger.debug("Could not download cookies file: %s", cookies_url)
+        return
+    # Replace file atomically, so workers never read partially written cookies:
+    cookies_path.parent.mkdir(parents=True, exist_ok=True)
+    cookies_tmp_path = cookies_path.with_name(cookies_path.name + ".tmp")
+    cookies_tmp_path.unlink(missing_ok=True)
+    cookies_tmp_path.write_bytes(r.content)
+    cookies_tmp_path.chmod(0o444)
+    os.replace(cookies_tmp_path, cookies_path)
+    COOKIES_STATE["etag"] = r.headers.get("ETag")
+    COOKIES_STATE["last_modified"] = r.headers.get("Last-Modified")
+    logger.debug("Cookies file refreshed: %s", cookies_path)
 
 
 def main():
+    STARTUP_SECONDS.labels(stage="import").set(time.monotonic() - STARTED)
     # Start exposing Prometheus/OpenMetrics metrics:
     prometheus_client.start_http_server(addr=METRICS_HOST, port=METRICS_PORT, registry=REGISTRY)
 
@@ -1445,22 +3253,8 @@ def main():
     #     with open(config_path, 'w') as config_file:
     #         config.write(config_file)
 
-    try:
-        with open(CHAT_STORAGE, "rb") as file:
-            data = pickle.load(file)
-        logger.info(f"Pickle file '{CHAT_STORAGE}' loaded successfully. Can continue loading persistence.")
-    except FileNotFoundError:
-        logger.info(f"The file '{CHAT_STORAGE}' does not exist, it will be created from scratch.")
-    except TypeError as e:
-        logger.info(f"TypeError occurred: {e}. Deleting the file...")
-        os.remove(CHAT_STORAGE)
-        logger.info(f"File '{CHAT_STORAGE}' has been deleted, it will be created from scratch.")
-    except Exception as e:
-        logger.info(f"An unexpected error occurred: {e}. Deleting the file...")
-        os.remove(CHAT_STORAGE)
-        logger.info(f"File '{CHAT_STORAGE}' has been deleted, it will be created from scratch.")
-
-    persistence = PicklePersistence(filepath=CHAT_STORAGE)
+    persistence = SqlitePersistence(filepath=CHAT_STORAGE)
+    persistence.migrate_pickle(CHAT_STORAGE_PICKLE)
 
     # https://docs.python-telegram-bot.org/en/v20.1/telegram.ext.applicationbuilder.html#telegram.ext.ApplicationBuilder
     # We use concurrent_updates with limit instead of unlimited create_task.
@@ -1488,7 +3282,6 @@ def main():
         .build()
     )
 
-    bot_username = requests.get(f"{TG_BOT_API}/bot{TG_BOT_TOKEN}/getMe").json()["result"]["username"]
     blacklist_whitelist_handler = MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, blacklist_whitelist_callback)
     start_command_handler = CommandHandler("start", start_help_commands_callback)
     help_command_handler = CommandHandler("help", start_help_commands_callback)
@@ -1497,7 +3290,7 @@ def main():
     link_command_handler = CommandHandler("link", dl_link_commands_and_messages_callback, filters=~filters.UpdateType.EDITED_MESSAGE & ~filters.FORWARDED)
     message_with_links_handler = MessageHandler(
         ~filters.UpdateType.EDITED_MESSAGE
-        & ~filters.ForwardedFrom(username=bot_username)
+        & ~FORWARDED_FROM_BOT
         & ~filters.COMMAND
         & (
             (filters.TEXT & (filters.Entity(MessageEntity.URL) | filters.Entity(MessageEntity.TEXT_LINK)))
@@ -1506,8 +3299,10 @@ def main():
         dl_link_commands_and_messages_callback,
     )
     button_query_handler = CallbackQueryHandler(button_press_callback)
+    first_update_handler = TypeHandler(Update, first_update_callback)
     unknown_handler = MessageHandler(filters.COMMAND, unknown_command_callback)
 
+    application.add_handler(first_update_handler, group=-1)
     application.add_handler(blacklist_whitelist_handler)
     application.add_handler(start_command_handler)
     application.add_handler(help_command_handler)
@@ -1521,7 +3316,14 @@ def main():
 
     job_queue = application.job_queue
     job_watchdog = job_queue.run_repeating(callback_watchdog, interval=60, first=10)
-    # job_monitor = job_queue.run_repeating(callback_monitor, interval=5, first=5)
+    job_monitor = job_queue.run_repeating(callback_monitor, interval=5, first=5)
+    job_queue_positions = job_queue.run_repeating(callback_queue_positions, interval=QUEUE_POSITION_INTERVAL, first=QUEUE_POSITION_INTERVAL)
+    if COOKIES_FILE:
+        job_cookies = job_queue.run_repeating(callback_cookies_refresh, interval=COOKIES_REFRESH_INTERVAL, first=COOKIES_REFRESH_INTERVAL)
+    job_ask_sweep = job_queue.run_repeating(callback_ask_sweep, interval=ASK_SWEEP_INTERVAL, first=60)
+    job_janitor = job_queue.run_repeating(callback_janitor, interval=JANITOR_INTERVAL, first=0)
+    if BROKER_JOBS:
+        job_broker_poll = job_queue.run_repeating(callback_job_broker_poll, interval=JOB_BROKER_POLL_INTERVAL, first=JOB_BROKER_POLL_INTERVAL)
 
     if WEBHOOK_ENABLE:
         application.run_webhook(
@@ -1548,5 +3350,67 @@ def main():
         )
 
 
+def report_job_done(broker, job_id, future):
+    # Runs in pebble thread, result is sent to bot through broker:
+    try:
+        broker.ack(job_id, future.result())
+    except TimeoutError:
+        broker.fail(job_id, "timeout")
+    except MemoryError:
+        broker.fail(job_id, "memory")
+    except ProcessExpired as exc:
+        broker.fail(job_id, "memory" if exc.exitcode == -signal.SIGKILL else "error")
+    except Exception:
+        logger.debug("Job failed: %s", job_id)
+        broker.fail(job_id, "error")
+
+
+def worker_main():
+    """Worker node: runs download jobs from JOB_BROKER in its own WORKERS processes and sends results to Telegram by itself."""
+    broker = get_job_broker()
+    if broker is None:
+        raise SystemExit("JOB_BROKER is not set")
+    worker_id = "{}:{}".format(platform.node(), os.getpid())
+    running = set()
+    # Cookies are fetched before the first job is reserved:
+    cookies_refreshed = None
+    janitor_run = 0
+    disk_full = False
+    SYSTEMD_NOTIFIER.notify("READY=1")
+    logger.info("Worker node %s started", worker_id)
+    try:
+        while True:
+            SYSTEMD_NOTIFIER.notify("WATCHDOG=1")
+            if COOKIES_FILE and (cookies_refreshed is None or time.monotonic() - cookies_refreshed > COOKIES_REFRESH_INTERVAL):
+                cookies_refreshed = time.monotonic()
+                run_async(callback_cookies_refresh(None))
+            if time.monotonic() - janitor_run > JANITOR_INTERVAL:
+                janitor_run = time.monotonic()
+                used, free = sweep_download_dirs()
+                # Jobs are left in broker for other nodes while this one has no disk space:
+                disk_full = bool(MIN_FREE_SPACE) and free < MIN_FREE_SPACE
+                if disk_full:
+                    logger.warning("Not reserving jobs, free space on DL_DIR disk: %s MiB", free // (1024 * 1024))
+            running = {future for future in running if not future.done()}
+            job = None
+            if len(running) < WORKERS and not disk_full:
+                job = broker.reserve(worker_id, visibility_timeout=DL_TIMEOUT + JOB_VISIBILITY_MARGIN, max_attempts=JOB_MAX_ATTEMPTS)
+            if job is None:
+                time.sleep(JOB_BROKER_POLL_INTERVAL)
+                continue
+            job_id, kwargs = job
+            logger.debug("Job %s reserved: %s", job_id, kwargs["url"])
+            # Cookies file path of bot host means nothing here:
+            kwargs["cookies_file"] = get_cookies_file()
+            future = submit_download(kwargs)
+            future.add_done_callback(functools.partial(report_job_done, broker, job_id))
+            running.add(future)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        EXECUTOR.stop()
+        EXECUTOR.join(timeout=10)
+
+
 if __name__ == "__main__":
     main()